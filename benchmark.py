@@ -0,0 +1,333 @@
+# benchmark.py
+"""
+Times the bot's hot paths against stand-ins for Discord, and writes the results to JSON so they can be compared across
+releases:
+
+- Drawing run statuses and reading them back, from the embedded payload and from the text, at 1/10/100 groups and
+  1/20/200 protection cards (and drawing them through tabulate, as the bot used to)
+- Reading the facility lists
+- Rolling and formatting dice
+- The alert and bonus dice rules
+- Whole commands, from the command callback to the status edit, with and without the run status cache
+
+Run `python benchmark.py --help` for the options. Doesn't connect to Discord.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import timeit
+import types
+
+import tabulate
+
+import dice
+import render
+import run
+
+
+class StubMessage:
+
+    def __init__(self, message_id, content='', embed=None):
+        self.id = message_id
+        self.content = content
+        self.embeds = [embed] if embed else []
+
+    async def edit(self, content=None, embed=None):
+        self.content = content
+        self.embeds = [embed] if embed else []
+
+    async def pin(self):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class StubChannel:
+
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.category = types.SimpleNamespace(name='runs-benchmark')
+        self.pinned = []
+        self.next_id = channel_id * 1000
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.next_id += 1
+        return StubMessage(self.next_id, content, embed)
+
+    async def pins(self):
+        return list(reversed(self.pinned))
+
+    def get_partial_message(self, message_id):
+        return next(message for message in self.pinned if message.id == message_id)
+
+
+class StubContext:
+
+    def __init__(self, channel: StubChannel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = types.SimpleNamespace(mention='@runner', nick='Runner 1', name='runner')
+        self.message = types.SimpleNamespace(author=self.author)
+
+    async def send(self, content=None, **kwargs):
+        return StubMessage(0, content)
+
+    async def reply(self, content=None, **kwargs):
+        return StubMessage(0, content)
+
+
+def example_status(cards: int, groups: int = 2, runners_per_group: int = 2):
+    card_ids = list(run.CARD_LIST)
+    status = run.RunStatus(alerts=7, current_depth=cards // 2, defenders=['Security One', 'Security Two'],
+                           active_group=1)
+
+    for group in range(groups):
+        for runner in range(runners_per_group):
+            status.add_to_group(group + 1, f'Runner {group * runners_per_group + runner + 1}')
+
+    for i in range(cards):
+        status.add_card(card_ids[i % len(card_ids)])
+        status.protection_cards[-1].boost = i % 4
+
+    return status
+
+
+def example_messages(status: run.RunStatus):
+    return [
+        StubMessage(i, content, run.page_embed(footer)) for i, (content, footer) in enumerate(status.pages())
+    ]
+
+
+def example_facility_message(facilities: int):
+    rows = [[f'Facility {i + 1}', random.choice(['Research', 'Server farm', 'Vault'])] for i in range(facilities)]
+    table = render.github_table(rows, ["Facility name", "Facility Type"])
+
+    return StubMessage(0, f'Example Corp facilities:\n```\n{table}\n```')
+
+
+def tabulate_status(status: run.RunStatus):
+    """The run status as it was drawn before the fixed-width renderer, through tabulate every time"""
+    defenders = ', '.join([f'`{x}`' for x in status.defenders])
+    defenders = f"\nDefenders: {defenders}" if defenders else ''
+    groups = '\n'.join([str(x) for x in sorted(status.groups, key=lambda x: x.group_num) if x.runners])
+    protection_cards = [
+        [' -> ' if i == status.current_depth else '', card.card_id, card.card_name, card.boost]
+        for i, card in enumerate(status.protection_cards)
+    ]
+    formatted_cards = '```\n{}\n```'.format(
+        tabulate.tabulate(protection_cards, ["", "Card ID", "Card name", "Boost"], tablefmt="github")
+    ) if protection_cards else ''
+    active_group = f"\nDefending facility from group {status.active_group}" if status.active_group else ''
+
+    return "`!!! Run status !!!`\n{}{}{}\nAlerts: {} (+{})\n{}".format(
+        groups, defenders, active_group, status.alerts, status.bonus_from_alerts(status.alerts), formatted_cards
+    )
+
+
+def clear_render_caches():
+    for function in [run.render_groups, run.render_defenders, run.render_protection_cards, render.render_row,
+                     render.render_separator, render.row_cells, render.render_table]:
+        function.cache_clear()
+
+
+def complete(coroutine):
+    """Runs a coroutine that never actually waits for anything, without an event loop"""
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+    raise RuntimeError('The coroutine waited for something')
+
+
+class Benchmark:
+
+    def __init__(self, repeat: int, min_time: float):
+        self.repeat = repeat
+        self.min_time = min_time
+        self.results = []
+
+    def time(self, name, function, **params):
+        timer = timeit.Timer(function)
+        number = 1
+
+        # Call it enough times per measurement that the clock's resolution doesn't matter
+        while timer.timeit(number) < self.min_time and number < 1000000:
+            number *= 2
+
+        times = [x / number * 1e6 for x in timer.repeat(repeat=self.repeat, number=number)]
+
+        result = {
+            'name': name,
+            'params': params,
+            'min_us': min(times),
+            'median_us': statistics.median(times),
+            'calls': number * self.repeat,
+        }
+        self.results.append(result)
+
+        described = ', '.join([f'{key}={value}' for (key, value) in params.items()])
+        print(f'{name:<36} {described:<28} {result["min_us"]:>12.2f}us {result["median_us"]:>12.2f}us')
+
+        return result
+
+
+def benchmark_statuses(bench: Benchmark, group_counts, card_counts):
+    for groups in group_counts:
+        for cards in card_counts:
+            status = example_status(cards, groups)
+            messages = example_messages(status)
+            content = '\n'.join([message.content for message in messages])
+
+            if str(status) != tabulate_status(status):
+                raise AssertionError(f'The renderer and tabulate disagree on a run with {groups} groups, {cards} cards')
+
+            if str(run.RunStatus.from_messages(messages)) != str(status):
+                raise AssertionError(f'A run with {groups} groups and {cards} cards doesn\'t read back the same')
+
+            def render_cold():
+                clear_render_caches()
+                return str(status)
+
+            def boost_one_card():
+                # What a boost command does: one card changes and the status is drawn again
+                status.protection_cards[status.current_depth].boost += 1
+                return str(status)
+
+            params = {'groups': groups, 'cards': cards, 'pages': len(messages)}
+
+            bench.time('RunStatus.__str__ (uncached)', render_cold, **params)
+            bench.time('RunStatus.__str__ (one card changed)', boost_one_card, **params)
+            bench.time('RunStatus.__str__ (tabulate)', lambda: tabulate_status(status), **params)
+            bench.time('RunStatus.pages', status.pages, **params)
+            bench.time('RunStatus.from_messages (payload)', lambda: run.RunStatus.from_messages(messages), **params)
+            bench.time('RunStatus.from_text', lambda: run.RunStatus.from_text(content), **params)
+            bench.time('round trip', lambda: run.RunStatus.from_messages(example_messages(status)), **params)
+
+
+def benchmark_facilities(bench: Benchmark, facility_counts):
+    for facilities in facility_counts:
+        message = example_facility_message(facilities)
+        bench.time('facility_from_message', lambda: complete(run.facility_from_message(message)), facilities=facilities)
+
+
+def benchmark_dice(bench: Benchmark):
+    threshold = run.dice_success_threshold
+
+    for die_strings in [['6d8'], ['20d8', '10d6', '+2'], ['1000d8']]:
+        pools, modifier = dice.parse_dice(die_strings)
+        rolls = dice.roll_pools(pools, threshold)
+        described = ' '.join(die_strings)
+
+        bench.time('dice.parse_dice', lambda: dice.parse_dice(die_strings), dice=described)
+        bench.time('dice.roll_pools', lambda: dice.roll_pools(pools, threshold), dice=described)
+        bench.time(
+            'dice.format_rolls', lambda: dice.format_rolls(rolls, modifier, threshold, run.dice_detail_limit),
+            dice=described
+        )
+
+
+def benchmark_rules(bench: Benchmark):
+    for alerts in [0, 10, 1000]:
+        bench.time('RunStatus.bonus_from_alerts', lambda: run.RunStatus.bonus_from_alerts(alerts), alerts=alerts)
+
+    for runners in [1, 4, 10]:
+        status = example_status(0, 1, runners)
+        bench.time('RunStatus.alerts_from_active_group', status.alerts_from_active_group, runners=runners)
+
+
+def benchmark_commands(bench: Benchmark, card_counts):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    guild = types.SimpleNamespace(id=1)
+
+    # Edit the status straight away, so each command's time includes its edit
+    run.status_editor.window = 0
+
+    for cards in card_counts:
+        channel = StubChannel(100 + cards, guild)
+        channel.pinned = example_messages(example_status(cards))
+        ctx = StubContext(channel)
+
+        def from_pins(command, *args):
+            run.run_cache.invalidate(channel.id)
+            return loop.run_until_complete(command.callback(ctx, *args))
+
+        def cached(command, *args):
+            return loop.run_until_complete(command.callback(ctx, *args))
+
+        bench.time('command alerts (cached)', lambda: cached(run.bot.get_command('alerts'), 1), cards=cards)
+        bench.time('command alerts (from pins)', lambda: from_pins(run.bot.get_command('alerts'), 1), cards=cards)
+        bench.time('command boost (cached)', lambda: cached(run.bot.get_command('boost'), 1), cards=cards)
+        bench.time('command run-status (cached)', lambda: cached(run.bot.get_command('run-status')), cards=cards)
+
+    ctx = StubContext(StubChannel(99, guild))
+
+    for die_strings in [['6d8'], ['20d8', '10d6', '+2']]:
+        bench.time(
+            'command roll', lambda: loop.run_until_complete(run.bot.get_command('roll').callback(ctx, *die_strings)),
+            dice=' '.join(die_strings)
+        )
+
+    loop.close()
+
+
+def compare(results, previous_path):
+    with open(previous_path) as previous_file:
+        previous = {
+            (x['name'], json.dumps(x['params'], sort_keys=True)): x for x in json.load(previous_file)['results']
+        }
+
+    print(f'\nCompared with {previous_path} (below 1.00x is faster now):')
+
+    for result in results:
+        old = previous.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+
+        if old:
+            described = ', '.join([f'{key}={value}' for (key, value) in result['params'].items()])
+            print(f'{result["name"]:<36} {described:<28} {result["min_us"] / old["min_us"]:>8.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the bot\'s hot paths')
+    parser.add_argument('--output', default='benchmark-results.json', help='Where to write the results')
+    parser.add_argument('--label', default=None, help='Something to tell this run apart, like the release')
+    parser.add_argument('--compare', default=None, help='Results from an earlier run to compare with')
+    parser.add_argument('--repeat', type=int, default=5, help='Measurements to take of each benchmark')
+    parser.add_argument('--min-time', type=float, default=0.02, help='Shortest time, in seconds, for a measurement')
+    parser.add_argument('--groups', type=int, nargs='+', default=[1, 10, 100], help='Runner groups in each run')
+    parser.add_argument('--cards', type=int, nargs='+', default=[1, 20, 200], help='Protection cards in each run')
+    parser.add_argument('--facilities', type=int, nargs='+', default=[1, 10, 50], help='Facilities in each list')
+    args = parser.parse_args()
+
+    random.seed(0)
+    benchmark = Benchmark(args.repeat, args.min_time)
+
+    print(f'{"Benchmark":<36} {"Parameters":<28} {"Min":>14} {"Median":>14}')
+
+    benchmark_statuses(benchmark, args.groups, args.cards)
+    benchmark_facilities(benchmark, args.facilities)
+    benchmark_dice(benchmark)
+    benchmark_rules(benchmark)
+    benchmark_commands(benchmark, args.cards)
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'label': args.label,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': benchmark.results,
+        }, output, indent=2)
+
+    print(f'\nWrote {len(benchmark.results)} results to {args.output}')
+
+    if args.compare:
+        compare(benchmark.results, args.compare)
@@ -0,0 +1,140 @@
+# build_card_images.py
+"""
+Builds smaller copies of every card image listed in cards.json, for the bot to send instead of the originals.
+
+Writes card-images/variants/<variant>/<card-id>.<ext> and a manifest.json next to them recording the size, dimensions
+and sha256 of every file. The bot reads the manifest at startup and picks a variant using CARD_IMAGE_VARIANT (or the
+smallest readable one if that isn't set). Cards whose original hasn't changed since the last build are skipped.
+
+Needs Pillow, which the bot itself doesn't: `pip install Pillow`
+"""
+import argparse
+import hashlib
+import json
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    raise SystemExit('Building card images needs Pillow - install it with `pip install Pillow`')
+
+IMAGE_DIRECTORY = 'card-images'
+VARIANT_DIRECTORY = os.path.join(IMAGE_DIRECTORY, 'variants')
+MANIFEST_PATH = os.path.join(VARIANT_DIRECTORY, 'manifest.json')
+
+
+def file_details(path):
+    with open(path, 'rb') as image_file:
+        data = image_file.read()
+
+    with Image.open(path) as image:
+        width, height = image.size
+
+    return {
+        'path': path.replace(os.sep, '/'),
+        'bytes': len(data),
+        'width': width,
+        'height': height,
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+
+
+def build_variants(card_id, source, colours, thumb_size, thumb_colours):
+    variants = {}
+
+    with Image.open(source) as image:
+        image.load()
+
+        # Quantising to a palette roughly halves these flat-coloured cards, and it's still a PNG everywhere
+        path = os.path.join(VARIANT_DIRECTORY, 'png', f'{card_id}.png')
+        image.quantize(colours, method=Image.FASTOCTREE).save(path, format='PNG', optimize=True)
+        variants['png'] = file_details(path)
+
+        path = os.path.join(VARIANT_DIRECTORY, 'webp', f'{card_id}.webp')
+        image.save(path, format='WEBP', lossless=True, method=6)
+        variants['webp'] = file_details(path)
+
+        # Shrinking with Lanczos (or saving lossy) smears the few flat colours into hundreds and comes out bigger than
+        # the full size WebP, so average each box of pixels and go back down to a small palette
+        thumb = image.copy()
+        thumb.thumbnail((thumb_size, thumb_size), Image.BOX)
+        path = os.path.join(VARIANT_DIRECTORY, 'thumb', f'{card_id}.webp')
+        thumb.quantize(thumb_colours, method=Image.FASTOCTREE).save(path, format='WEBP', lossless=True, method=6)
+        variants['thumb'] = file_details(path)
+
+    return variants
+
+
+def build(colours, thumb_size, thumb_colours, force=False):
+    with open('cards.json') as cards:
+        card_list = json.load(cards)
+
+    for variant in ['png', 'webp', 'thumb']:
+        os.makedirs(os.path.join(VARIANT_DIRECTORY, variant), exist_ok=True)
+
+    manifest = {'cards': {}}
+
+    if os.path.exists(MANIFEST_PATH) and not force:
+        with open(MANIFEST_PATH) as previous:
+            manifest = json.load(previous)
+
+    options = {'colours': colours, 'thumb_size': thumb_size, 'thumb_colours': thumb_colours}
+    if manifest.get('options') != options:
+        manifest = {'cards': {}}
+
+    manifest['options'] = options
+
+    built = 0
+    skipped = 0
+    missing = []
+
+    for card_id in card_list:
+        source = os.path.join(IMAGE_DIRECTORY, f'{card_id}.png')
+
+        if not os.path.exists(source):
+            missing.append(card_id)
+            continue
+
+        original = file_details(source)
+        previous = manifest['cards'].get(card_id)
+
+        if previous and previous['original']['sha256'] == original['sha256'] and all(
+                os.path.exists(variant['path']) for variant in previous.values()
+        ):
+            skipped += 1
+            continue
+
+        manifest['cards'][card_id] = {
+            'original': original, **build_variants(card_id, source, colours, thumb_size, thumb_colours)
+        }
+        built += 1
+
+    # Forget cards that have been taken out of cards.json
+    manifest['cards'] = {card_id: manifest['cards'][card_id] for card_id in card_list if card_id in manifest['cards']}
+
+    with open(MANIFEST_PATH, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    totals = {}
+    for variants in manifest['cards'].values():
+        for variant, details in variants.items():
+            totals[variant] = totals.get(variant, 0) + details['bytes']
+
+    print(f'Built {built} cards, {skipped} unchanged')
+
+    if missing:
+        print(f'No image for: {", ".join(missing)}')
+
+    for variant, total in totals.items():
+        print(f'{variant}: {total / 1024 / 1024:.2f}MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds optimised copies of the card images')
+    parser.add_argument('--colours', type=int, default=256, help='Number of colours in the palette PNGs')
+    parser.add_argument('--thumb-size', type=int, default=240, help='Longest side of the thumbnails, in pixels')
+    parser.add_argument('--thumb-colours', type=int, default=16, help='Number of colours in the thumbnails')
+    parser.add_argument('--force', action='store_true', help='Rebuild every card, even if it hasn\'t changed')
+    args = parser.parse_args()
+
+    build(args.colours, args.thumb_size, args.thumb_colours, args.force)
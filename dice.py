@@ -0,0 +1,242 @@
+# dice.py
+import collections
+import functools
+import itertools
+import math
+import random
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+pool_regex = re.compile('^(\\d*)d(\\d+)$')
+modifier_regex = re.compile('^[+-]\\d+$')
+
+
+class DicePool:
+
+    def __init__(self, amount: int, sides: int):
+        self.amount = amount
+        self.sides = sides
+
+    def __str__(self):
+        return f'{self.amount}d{self.sides}'
+
+
+class PoolRoll:
+
+    def __init__(self, pool: DicePool, values, successes: int):
+        self.pool = pool
+        self.values = values
+        self.successes = successes
+
+
+def parse_dice(dice, max_sides=None):
+    """
+    Turns something like ['6d8', '4d6', '+2'] into the pools to roll and the modifier to add to the successes. Raises a
+    ValueError if anything doesn't look like dice, or has more than max_sides sides
+    """
+    pools = []
+    modifier = 0
+
+    for die_string in dice:
+        die_string = die_string.lower()
+        match = pool_regex.match(die_string)
+
+        if match:
+            amount = int(match.group(1)) if match.group(1) else 1
+            sides = int(match.group(2))
+
+            if sides < 1:
+                raise ValueError(f'`{die_string}` has no sides')
+
+            if max_sides is not None and sides > max_sides:
+                raise ValueError(f'`{die_string}` has too many sides - dice can have at most {max_sides}')
+
+            pools.append(DicePool(amount, sides))
+        elif modifier_regex.match(die_string):
+            modifier += int(die_string)
+        else:
+            raise ValueError(f'`{die_string}` isn\'t a dice pool')
+
+    if not pools:
+        raise ValueError('No dice to roll')
+
+    return pools, modifier
+
+
+def roll_pools(pools, threshold: int, rng=None):
+    """
+    Rolls every pool in one go. Uses numpy when it's installed, in which case each pool's values are an array rather
+    than a list
+    """
+    if numpy is not None:
+        rng = rng or numpy.random.default_rng()
+        sides = numpy.repeat([pool.sides for pool in pools], [pool.amount for pool in pools])
+        values = rng.integers(1, sides + 1) if len(sides) else numpy.zeros(0, dtype=int)
+        ends = numpy.cumsum([pool.amount for pool in pools])
+
+        return [
+            PoolRoll(pool, pool_values, int(numpy.count_nonzero(pool_values >= threshold)))
+            for pool, pool_values in zip(pools, numpy.split(values, ends[:-1]))
+        ]
+
+    rng = rng or random
+    rolls = []
+
+    for pool in pools:
+        values = rng.choices(range(1, pool.sides + 1), k=pool.amount)
+        rolls.append(PoolRoll(pool, values, sum(1 for x in values if x >= threshold)))
+
+    return rolls
+
+
+def format_pool(roll: PoolRoll, threshold: int, detailed: bool):
+    if not detailed:
+        # Far too many dice to list, so just say how many of each face came up
+        if numpy is not None:
+            faces, counts = numpy.unique(roll.values, return_counts=True)
+            counts = dict(zip(faces.tolist(), counts.tolist()))
+        else:
+            counts = collections.Counter(roll.values)
+
+        faces = [f'{face}s: {counts[face]}' for face in sorted(counts, reverse=True)]
+
+        return f'Too many dice to list - {", ".join(faces)}'
+
+    values = sorted((int(x) for x in roll.values), reverse=True)
+
+    return 'Rolls: ' + ', '.join([f"**{x}**" if x >= threshold else str(x) for x in values])
+
+
+def shorten(text: str, max_length: int):
+    """Cuts text down to max_length at the last comma or line that fits, marking that some was left off"""
+    if len(text) <= max_length:
+        return text
+
+    cut = max(text.rfind(', ', 0, max_length - 2), text.rfind('\n', 0, max_length - 2))
+
+    return text[:cut if cut > 0 else max_length - 2] + ' …'
+
+
+def format_rolls(rolls, modifier: int, threshold: int, detail_limit: int, max_length=None):
+    """
+    Every die is listed if there are at most detail_limit of them across all the pools, otherwise how many of each face
+    came up. Cut down to max_length, if given
+    """
+    total = sum(roll.successes for roll in rolls) + modifier
+    detailed = sum(roll.pool.amount for roll in rolls) <= detail_limit
+
+    def text(detailed):
+        if len(rolls) == 1 and not modifier:
+            return f'{total} successes\n{format_pool(rolls[0], threshold, detailed)}'
+
+        lines = [
+            f'{roll.pool}: {roll.successes} successes - {format_pool(roll, threshold, detailed)}' for roll in rolls
+        ]
+        modifier_text = f' ({modifier:+d})' if modifier else ''
+
+        return f'{total} successes{modifier_text}\n' + '\n'.join(lines)
+
+    result = text(detailed)
+
+    if max_length is None or len(result) <= max_length:
+        return result
+
+    # Listing the dice was too long, so count the faces instead, and failing that leave some off
+    return shorten(text(False) if detailed else result, max_length)
+
+
+@functools.lru_cache(maxsize=None)
+def success_distribution(amount: int, sides: int, threshold: int):
+    """
+    The chance of each number of successes (0 up to amount) when rolling amount dice with the given number of sides.
+    Worked out in log space, so it holds up for pools of hundreds of dice
+    """
+    p = min(max(sides - threshold + 1, 0), sides) / sides
+
+    if p in (0, 1):
+        return tuple(1.0 if successes == amount * p else 0.0 for successes in range(amount + 1))
+
+    log_p = math.log(p)
+    log_q = math.log(1 - p)
+    log_n = math.lgamma(amount + 1)
+
+    return tuple(
+        math.exp(
+            log_n - math.lgamma(k + 1) - math.lgamma(amount - k + 1) + k * log_p + (amount - k) * log_q
+        )
+        for k in range(amount + 1)
+    )
+
+
+def convolve(first, second):
+    if numpy is not None:
+        return tuple(numpy.convolve(first, second).tolist())
+
+    combined = [0.0] * (len(first) + len(second) - 1)
+
+    for i, a in enumerate(first):
+        if not a:
+            continue
+
+        for j, b in enumerate(second):
+            combined[i + j] += a * b
+
+    return tuple(combined)
+
+
+@functools.lru_cache(maxsize=4096)
+def pools_distribution(pools, threshold: int):
+    """
+    The chance of each total number of successes across several pools, where pools is a sorted tuple of
+    (amount, sides) pairs so that the same pools share one cache entry whatever order they were asked for in
+    """
+    distribution = (1.0,)
+
+    for amount, sides in pools:
+        distribution = convolve(distribution, success_distribution(amount, sides, threshold))
+
+    return distribution
+
+
+def distribution_for(pools, threshold: int):
+    return pools_distribution(tuple(sorted((pool.amount, pool.sides) for pool in pools)), threshold)
+
+
+def precompute_distributions(sides_list, max_amount: int, threshold: int):
+    for sides in sides_list:
+        for amount in range(max_amount + 1):
+            success_distribution(amount, sides, threshold)
+
+
+def compare_distributions(attacker, defender, shift: int = 0):
+    """
+    Chances that the attacker gets more successes than the defender, the same, or fewer, with shift added to the
+    attacker's successes
+    """
+    # at_most[i] is the chance of the defender getting i or fewer successes
+    at_most = list(itertools.accumulate(defender))
+
+    def defender_at_most(successes):
+        if successes < 0:
+            return 0.0
+
+        return at_most[min(successes, len(at_most) - 1)]
+
+    win = tie = 0.0
+
+    for successes, chance in enumerate(attacker):
+        total = successes + shift
+        win += chance * defender_at_most(total - 1)
+
+        if 0 <= total < len(defender):
+            tie += chance * defender[total]
+
+    return win, tie, max(0.0, 1 - win - tie)
+
+
+def expected_successes(distribution):
+    return sum(successes * chance for successes, chance in enumerate(distribution))
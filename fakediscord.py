@@ -0,0 +1,509 @@
+# fakediscord.py
+"""
+In-memory stand-ins for the bits of Discord the bot uses: guilds, categories, channels, roles, members, messages and
+pins. Every call that would be a REST request to Discord goes through FakeDiscord.request, which counts it, holds it
+back if it would go over a rate limit (as discord.py does when it gets a 429), and waits for a simulated round trip.
+
+Only covers what run.py actually calls. Used by loadtest.py.
+"""
+import asyncio
+import collections
+import contextvars
+import datetime
+import itertools
+import random
+import time
+from typing import Optional
+
+import discord
+
+# What the requests being made are for, e.g. the command being run - they're counted against it in FakeDiscord.labelled
+request_label = contextvars.ContextVar('request_label', default='other')
+
+
+class RateLimit:
+    """At most `limit` requests in any `period` seconds"""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.sent = collections.deque()
+
+    def wait_time(self, now):
+        while self.sent and now - self.sent[0] >= self.period:
+            self.sent.popleft()
+
+        if len(self.sent) < self.limit:
+            return 0
+
+        return self.sent[0] + self.period - now
+
+
+class FakeDiscord:
+    """
+    Shared state for a fake Discord: IDs, simulated latency, rate limits, and the counts of requests made, per route
+    and per request_label. `dispatch` is called with an event name and its arguments for the gateway events the bot
+    listens to
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, route_limit=(5, 5.0), global_limit=(50, 1.0),
+                 dispatch=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.route_limit = route_limit
+        self.global_limit = RateLimit(*global_limit) if global_limit else None
+        self.buckets = {}
+        self.dispatch = dispatch or (lambda event, *args: None)
+        self.rng = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.requests = collections.Counter()
+        self.labelled = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.waited = 0.0
+
+    def next_id(self):
+        # Real snowflakes start with a timestamp, so later IDs sort after earlier ones
+        return (int(time.time() * 1000) - discord.utils.DISCORD_EPOCH) << 22 | next(self.ids) & 0x3fffff
+
+    async def request(self, route: str, major_id=None):
+        """Stands in for one REST request to `route`, rate limited per route and major ID (channel or guild)"""
+        self.requests[route] += 1
+        self.labelled[(request_label.get(), route)] += 1
+
+        limits = [self.global_limit] if self.global_limit else []
+
+        if self.route_limit:
+            bucket = self.buckets.setdefault((route, major_id), RateLimit(*self.route_limit))
+            limits.append(bucket)
+
+        limited = False
+
+        while True:
+            now = time.monotonic()
+            wait = max([limit.wait_time(now) for limit in limits] + [0])
+
+            if not wait:
+                break
+
+            if not limited:
+                self.rate_limited[route] += 1
+                limited = True
+
+            self.waited += wait
+            await asyncio.sleep(wait)
+
+        for limit in limits:
+            limit.sent.append(time.monotonic())
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.rng.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+
+    def guild(self, name='Running Hot'):
+        return FakeGuild(self, name)
+
+
+class FakeRole(discord.Role):
+    """A real discord.Role as far as isinstance is concerned, which run_role_from_channel relies on"""
+
+    def __init__(self, guild: 'FakeGuild', name: str):
+        self.guild = guild
+        self.id = guild.discord.next_id()
+        self.name = name
+
+    async def delete(self, *, reason=None):
+        await self.guild.discord.request('DELETE /guilds/{guild_id}/roles/{role_id}', self.guild.id)
+
+        self.guild.remove_role(self)
+
+        for member in self.guild.members:
+            if self in member.roles:
+                member.roles.remove(self)
+
+
+class FakeMember:
+
+    def __init__(self, guild: 'FakeGuild', name: str, nick: Optional[str] = None, roles=None):
+        self.guild = guild
+        self.id = guild.discord.next_id()
+        self.name = name
+        self.nick = nick
+        self.roles = list(roles or [])
+        self.bot = False
+
+    @property
+    def mention(self):
+        return f'<@!{self.id}>'
+
+    @property
+    def display_name(self):
+        return self.nick or self.name
+
+    async def add_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.guild.discord.request('PUT /guilds/{guild_id}/members/{user_id}/roles/{role_id}', self.guild.id)
+
+            if role not in self.roles:
+                self.roles.append(role)
+
+    async def remove_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.guild.discord.request(
+                'DELETE /guilds/{guild_id}/members/{user_id}/roles/{role_id}', self.guild.id
+            )
+
+            if role in self.roles:
+                self.roles.remove(role)
+
+
+class FakeAttachment:
+
+    def __init__(self, url: str, filename: str):
+        self.url = url
+        self.filename = filename
+
+
+class FakeMessage:
+
+    def __init__(self, channel: 'FakeTextChannel', author, content=None, embed=None, file=None):
+        self.channel = channel
+        self.guild = channel.guild
+        self.id = channel.guild.discord.next_id()
+        self.author = author
+        self.content = content or ''
+        self.embeds = [embed] if embed else []
+        self.attachments = []
+        self.pinned = False
+        self.created_at = datetime.datetime.utcnow()
+
+        if file:
+            self.attachments.append(FakeAttachment(
+                f'https://cdn.discordapp.test/attachments/{channel.id}/{self.id}/{file.filename}', file.filename
+            ))
+            file.close()
+
+    async def edit(self, *, content=None, embed=None):
+        await self.guild.discord.request('PATCH /channels/{channel_id}/messages/{message_id}', self.channel.id)
+
+        self.content = content or ''
+        self.embeds = [embed] if embed else []
+
+    async def pin(self, *, reason=None):
+        await self.guild.discord.request('PUT /channels/{channel_id}/pins/{message_id}', self.channel.id)
+
+        if not self.pinned:
+            self.pinned = True
+            self.channel.pinned.append(self)
+            self.guild.discord.dispatch('guild_channel_pins_update', self.channel, datetime.datetime.utcnow())
+
+    async def unpin(self, *, reason=None):
+        await self.guild.discord.request('DELETE /channels/{channel_id}/pins/{message_id}', self.channel.id)
+        self.channel.forget_pin(self)
+
+    async def delete(self, *, delay=None):
+        await self.guild.discord.request('DELETE /channels/{channel_id}/messages/{message_id}', self.channel.id)
+
+        if self not in self.channel.messages:
+            raise discord.NotFound(FakeResponse(404), 'Unknown Message')
+
+        self.channel.remove_messages([self])
+
+
+class FakeResponse:
+    """Just enough of an aiohttp response for discord.HTTPException"""
+
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = 'Not Found' if status == 404 else 'Error'
+
+
+class FakeHistory:
+    """What channel.history() returns: async iterable, or flatten() for a list. Fetches 100 messages a request"""
+
+    def __init__(self, channel: 'FakeTextChannel', limit, after):
+        self.channel = channel
+        self.limit = limit
+        self.after = after
+
+    async def flatten(self):
+        return [message async for message in self]
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        messages = [x for x in reversed(self.channel.messages) if not self.after or x.created_at > self.after]
+
+        if self.limit is not None:
+            messages = messages[:self.limit]
+
+        for i in range(0, max(len(messages), 1), 100):
+            await self.channel.guild.discord.request('GET /channels/{channel_id}/messages', self.channel.id)
+
+            for message in messages[i:i + 100]:
+                yield message
+
+
+class FakeGuildChannel:
+
+    def __init__(self, guild: 'FakeGuild', name: str, category=None, overwrites=None):
+        self.guild = guild
+        self.id = guild.discord.next_id()
+        self.name = name
+        self.category = category
+        self.overwrites = dict(overwrites or {})
+        self.position = len(guild.channels)
+
+    @property
+    def mention(self):
+        return f'<#{self.id}>'
+
+    async def edit(self, *, reason=None, **options):
+        await self.guild.discord.request('PATCH /channels/{channel_id}', self.id)
+
+        for name, value in options.items():
+            setattr(self, name, value)
+
+    async def clone(self, *, name=None, reason=None):
+        await self.guild.discord.request('POST /guilds/{guild_id}/channels', self.guild.id)
+
+        # Like Discord, the copy goes to the end of its category
+        channel = type(self)(self.guild, name or self.name, self.category, self.overwrites)
+        self.guild.channels.append(channel)
+
+        return channel
+
+    async def set_permissions(self, target, *, overwrite=None, reason=None, **permissions):
+        await self.guild.discord.request('PUT /channels/{channel_id}/permissions/{overwrite_id}', self.id)
+
+        self.overwrites[target] = overwrite or discord.PermissionOverwrite(**permissions)
+
+    async def delete(self, *, reason=None):
+        await self.guild.discord.request('DELETE /channels/{channel_id}', self.id)
+
+        self.guild.remove_channel(self)
+        self.guild.discord.dispatch('guild_channel_delete', self)
+
+
+class FakeTextChannel(FakeGuildChannel):
+
+    def __init__(self, guild: 'FakeGuild', name: str, category=None, overwrites=None):
+        super().__init__(guild, name, category, overwrites)
+        self.messages = []
+        self.pinned = []
+
+    async def send(self, content=None, *, embed=None, file=None, author=None, **kwargs):
+        await self.guild.discord.request('POST /channels/{channel_id}/messages', self.id)
+
+        message = FakeMessage(self, author or self.guild.me, content, embed, file)
+        self.messages.append(message)
+
+        return message
+
+    async def pins(self):
+        await self.guild.discord.request('GET /channels/{channel_id}/pins', self.id)
+
+        return list(reversed(self.pinned))
+
+    def history(self, limit=100, after=None, **kwargs):
+        return FakeHistory(self, limit, after)
+
+    async def delete_messages(self, messages):
+        messages = list(messages)
+
+        if len(messages) == 1:
+            await messages[0].delete()
+            return
+
+        await self.guild.discord.request('POST /channels/{channel_id}/messages/bulk-delete', self.id)
+        self.remove_messages(messages)
+
+    def remove_messages(self, messages):
+        for message in messages:
+            if message in self.messages:
+                self.messages.remove(message)
+
+            self.forget_pin(message)
+
+    def forget_pin(self, message: FakeMessage):
+        if message.pinned:
+            message.pinned = False
+            self.pinned.remove(message)
+            self.guild.discord.dispatch('guild_channel_pins_update', self, None)
+
+    def get_partial_message(self, message_id):
+        return FakePartialMessage(self, message_id)
+
+    async def fetch_message(self, message_id):
+        await self.guild.discord.request('GET /channels/{channel_id}/messages/{message_id}', self.id)
+
+        return self.find_message(message_id)
+
+    def find_message(self, message_id) -> FakeMessage:
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+
+        raise discord.NotFound(FakeResponse(404), 'Unknown Message')
+
+
+class FakePartialMessage:
+    """A message known only by ID, like discord.PartialMessage - it only finds out it's gone when it's used"""
+
+    def __init__(self, channel: FakeTextChannel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, **fields):
+        try:
+            message = self.channel.find_message(self.id)
+        except discord.NotFound:
+            await self.channel.guild.discord.request('PATCH /channels/{channel_id}/messages/{message_id}',
+                                                     self.channel.id)
+            raise
+
+        await message.edit(**fields)
+
+    async def pin(self, **kwargs):
+        await self.channel.find_message(self.id).pin(**kwargs)
+
+    async def delete(self, **kwargs):
+        await self.channel.find_message(self.id).delete(**kwargs)
+
+
+class FakeVoiceChannel(FakeGuildChannel):
+    pass
+
+
+class FakeCategory(FakeGuildChannel):
+
+    @property
+    def channels(self):
+        return [x for x in self.guild.channels if x.category is self]
+
+    @property
+    def text_channels(self):
+        return [x for x in self.channels if isinstance(x, FakeTextChannel)]
+
+    @property
+    def voice_channels(self):
+        return [x for x in self.channels if isinstance(x, FakeVoiceChannel)]
+
+
+class FakeGuild:
+
+    def __init__(self, discord_state: FakeDiscord, name: str):
+        self.discord = discord_state
+        self.id = discord_state.next_id()
+        self.name = name
+        self.channels = []
+        self.members = []
+        self.role_list = []
+        self.default_role = FakeRole(self, '@everyone')
+        self.me = FakeMember(self, 'running-hot-bot')
+        self.me.bot = True
+
+    @property
+    def roles(self):
+        # A new list each time, as discord.py gives, so deleting roles while looping over them works
+        return list(self.role_list)
+
+    @property
+    def categories(self):
+        return [x for x in self.channels if isinstance(x, FakeCategory)]
+
+    @property
+    def text_channels(self):
+        return [x for x in self.channels if isinstance(x, FakeTextChannel)]
+
+    @property
+    def voice_channels(self):
+        return [x for x in self.channels if isinstance(x, FakeVoiceChannel)]
+
+    def get_channel(self, channel_id):
+        return discord.utils.get(self.channels, id=channel_id)
+
+    def get_member(self, member_id):
+        return discord.utils.get(self.members, id=member_id)
+
+    def add_member(self, name, nick=None, roles=None) -> FakeMember:
+        """Sets up a member, as if they'd already joined - not a request"""
+        member = FakeMember(self, name, nick, roles)
+        self.members.append(member)
+
+        return member
+
+    def add_role(self, name) -> FakeRole:
+        """Sets up a role without a request, for building the starting guild"""
+        role = FakeRole(self, name)
+        self.role_list.append(role)
+
+        return role
+
+    def remove_role(self, role):
+        if role in self.role_list:
+            self.role_list.remove(role)
+
+    def remove_channel(self, channel):
+        if channel in self.channels:
+            self.channels.remove(channel)
+
+    async def create_role(self, *, name, reason=None, **fields):
+        await self.discord.request('POST /guilds/{guild_id}/roles', self.id)
+
+        return self.add_role(name)
+
+    async def create_category(self, name, *, overwrites=None, reason=None, position=None):
+        await self.discord.request('POST /guilds/{guild_id}/channels', self.id)
+
+        category = FakeCategory(self, name, None, overwrites)
+        self.channels.append(category)
+
+        return category
+
+    async def create_text_channel(self, name, *, category=None, overwrites=None, reason=None, **options):
+        await self.discord.request('POST /guilds/{guild_id}/channels', self.id)
+
+        channel = FakeTextChannel(self, name, category, overwrites)
+        self.channels.append(channel)
+
+        return channel
+
+    async def create_voice_channel(self, name, *, category=None, overwrites=None, reason=None, **options):
+        await self.discord.request('POST /guilds/{guild_id}/channels', self.id)
+
+        channel = FakeVoiceChannel(self, name, category, overwrites)
+        self.channels.append(channel)
+
+        return channel
+
+    async def fetch_roles(self):
+        await self.discord.request('GET /guilds/{guild_id}/roles', self.id)
+
+        return self.roles
+
+    async def fetch_channels(self):
+        await self.discord.request('GET /guilds/{guild_id}/channels', self.id)
+
+        return list(self.channels)
+
+    async def query_members(self, query=None, *, limit=5, **kwargs):
+        # Goes over the gateway rather than REST, but costs a round trip all the same
+        await self.discord.request('GATEWAY request_guild_members', self.id)
+
+        return [x for x in self.members if (x.nick or x.name).startswith(query or '')][:limit]
+
+
+class FakeContext:
+    """What a command callback gets as ctx: who sent the command, and where"""
+
+    def __init__(self, channel: FakeTextChannel, author: FakeMember, content=''):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.message = FakeMessage(channel, author, content)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
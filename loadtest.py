@@ -0,0 +1,289 @@
+# loadtest.py
+"""
+Plays a lot of runs at once against the in-memory Discord in fakediscord.py, through the bot's real command callbacks,
+and reports how long each command took and how many requests it made of Discord.
+
+Each run has a few runners and a security player. They join with run-facility, security defends and starts the run,
+the runners add their alerts, then for each protection card security plays it and boosts it, a runner works out its
+strength and the runners roll. Once every run is over, Control clears them all with clear-runs. Players wait a random
+think time before each command.
+
+Commands are called straight through their callbacks, so the role checks and argument converters are skipped. Run
+`python loadtest.py --help` for the options. Doesn't connect to Discord.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Don't touch the real upload cache, and start each load test without one
+os.environ.setdefault('CARD_URL_CACHE_PATH', os.path.join(tempfile.mkdtemp(), 'card-urls.json'))
+
+import fakediscord
+import rules
+import run
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+class LoadTest:
+
+    def __init__(self, fake: fakediscord.FakeDiscord, think_time: float, seed=None):
+        self.fake = fake
+        self.think_time = think_time
+        self.rng = random.Random(seed)
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.first_errors = {}
+        self.guild = None
+        self.control = None
+        self.control_channel = None
+
+    def build_guild(self, runs: int, runners: int):
+        """The starting guild: the corporation and Control roles, a facility for each run, and the players"""
+        guild = self.fake.guild()
+        self.guild = guild
+
+        control_role = guild.add_role(run.control_role_name)
+        guild.add_role('bot-master')
+        corp_roles = {short_corp: guild.add_role(name) for (short_corp, name) in run.CORPORATION_ROLE_NAMES.items()}
+        categories = {}
+
+        for short_corp in run.CORPORATION_NAMES:
+            category = fakediscord.FakeCategory(guild, f'runs-{short_corp}')
+            guild.channels.append(category)
+            categories[short_corp] = category
+
+        self.control = guild.add_member('control', 'Control', [control_role])
+        self.control_channel = fakediscord.FakeTextChannel(guild, 'control')
+        guild.channels.append(self.control_channel)
+
+        games = []
+
+        for i in range(runs):
+            short_corp = list(run.CORPORATION_NAMES)[i % len(run.CORPORATION_NAMES)]
+            facility = f'facility{i + 1}'
+
+            for channel_type in [fakediscord.FakeTextChannel, fakediscord.FakeVoiceChannel]:
+                guild.channels.append(channel_type(guild, f'{short_corp}-{facility}', categories[short_corp]))
+
+            players = [
+                guild.add_member(f'runner{i + 1}-{j + 1}', f'Runner {i + 1}-{j + 1}', [corp_roles[short_corp]])
+                for j in range(runners)
+            ]
+            security = guild.add_member(f'security{i + 1}', f'Security {i + 1}', [corp_roles[short_corp]])
+
+            games.append((short_corp, facility, players, security))
+
+        return games
+
+    async def invoke(self, name, channel, author, *args, **kwargs):
+        """Calls a command's callback as `author` typing it in `channel`, and times it"""
+        if self.think_time:
+            await asyncio.sleep(self.rng.uniform(0, self.think_time))
+
+        command = run.bot.get_command(name)
+        content = ' '.join([f'{run.command_prefix}{name}'] + [str(x) for x in list(args) + list(kwargs.values())])
+        ctx = fakediscord.FakeContext(channel, author, content)
+        label = fakediscord.request_label.set(name)
+        started = time.perf_counter()
+
+        try:
+            await command.callback(ctx, *args, **kwargs)
+        except Exception as error:
+            self.errors[name] += 1
+            self.first_errors.setdefault(name, repr(error))
+        finally:
+            self.latencies[name].append(time.perf_counter() - started)
+            fakediscord.request_label.reset(label)
+
+    async def play_run(self, short_corp, facility, runners, security, cards: int):
+        channel = discord_channel(self.guild, f'{short_corp}-{facility}')
+
+        # The first runner sets the run up, then everyone else joins at once
+        await self.invoke('run-facility', channel, runners[0], short_corp, facility)
+        await asyncio.gather(*[
+            self.invoke('run-facility', channel, player, short_corp, facility) for player in runners[1:] + [security]
+        ])
+
+        await self.invoke('defend', channel, security)
+        await self.invoke('start-run', channel, security, 1)
+        await asyncio.gather(*[self.invoke('alerts', channel, player, 1) for player in runners])
+
+        card_ids = list(run.CARD_LIST)
+
+        for _ in range(cards):
+            await self.invoke('next-card', channel, security, self.rng.choice(card_ids))
+            await self.invoke('boost', channel, security, 1)
+            await self.invoke('calculate-strength', channel, self.rng.choice(runners))
+            await asyncio.gather(*[self.invoke('roll', channel, player, '6d8') for player in runners])
+
+        return channel
+
+    async def check_status(self, channel, runners, cards: int):
+        """
+        Whether the pinned status has every runner, every runner's alert and every card with its one boost, i.e. no
+        command's changes were lost - the joins and alerts are sent at the same time, so they're the ones at risk
+        """
+        status = run.RunStatus.from_messages(run.status_pages_from_pins(await channel.pins()))
+        on_run = sorted(runner for group in status.groups for runner in group.runners)
+
+        return (
+            on_run == sorted(x.nick for x in runners)
+            and status.alerts == rules.alerts_for_runners(len(runners)) + len(runners)
+            and len(status.protection_cards) == cards
+            and all(card.boost == 1 for card in status.protection_cards)
+        )
+
+    async def play(self, games, cards: int):
+        started = time.perf_counter()
+        channels = await asyncio.gather(*[
+            self.play_run(short_corp, facility, runners, security, cards)
+            for (short_corp, facility, runners, security) in games
+        ])
+
+        await run.status_editor.flush_all()
+
+        lost = [
+            channel.name for channel, (_, _, runners, _) in zip(channels, games)
+            if not await self.check_status(channel, runners, cards)
+        ]
+
+        await self.invoke('clear-runs', self.control_channel, self.control)
+
+        return time.perf_counter() - started, lost
+
+    def report(self, elapsed: float, lost):
+        commands = sum(len(x) for x in self.latencies.values())
+        requests = sum(self.fake.requests.values())
+        by_command = collections.Counter()
+
+        for (label, _), count in self.fake.labelled.items():
+            by_command[label] += count
+
+        print(f'{"Command":<20} {"Count":>6} {"Errors":>6} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} '
+              f'{"Max ms":>9} {"Requests":>9}')
+
+        for name, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            print(f'{name:<20} {len(latencies):>6} {self.errors[name]:>6} '
+                  f'{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 90) * 1000:>9.1f} '
+                  f'{percentile(latencies, 99) * 1000:>9.1f} {latencies[-1] * 1000:>9.1f} '
+                  f'{by_command[name] / len(latencies):>9.2f}')
+
+        print(f'\n{"Route":<64} {"Requests":>9} {"Limited":>8}')
+
+        for route, count in self.fake.requests.most_common():
+            print(f'{route:<64} {count:>9} {self.fake.rate_limited[route]:>8}')
+
+        print(f'\n{commands} commands in {elapsed:.2f}s ({commands / elapsed:.1f}/s), {requests} requests, '
+              f'{sum(self.fake.rate_limited.values())} held back by rate limits for {self.fake.waited:.2f}s in total')
+
+        if by_command['other']:
+            print(f'{by_command["other"]} requests made outside any command (e.g. the final status edits)')
+
+        for name, error in self.first_errors.items():
+            print(f'First error from {name}: {error}')
+
+        if lost:
+            print(f'Lost status updates in {len(lost)} runs: {", ".join(lost)}')
+
+    def results(self, elapsed: float, lost):
+        commands = {}
+
+        for name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            commands[name] = {
+                'count': len(latencies),
+                'errors': self.errors[name],
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p90_ms': percentile(latencies, 90) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+                'requests': sum(count for (label, _), count in self.fake.labelled.items() if label == name),
+            }
+
+        return {
+            'created': datetime.datetime.utcnow().isoformat(),
+            'python': sys.version.split()[0],
+            'elapsed_s': elapsed,
+            'commands': commands,
+            'routes': {
+                route: {'requests': count, 'rate_limited': self.fake.rate_limited[route]}
+                for route, count in self.fake.requests.items()
+            },
+            'waited_s': self.fake.waited,
+            'lost_updates': lost,
+        }
+
+
+def discord_channel(guild, name):
+    return next(x for x in guild.text_channels if x.name == name)
+
+
+def dispatch(event, *args):
+    """Hands gateway events from the fake Discord to the bot's own handlers, as discord.py would"""
+    handler = getattr(run, f'on_{event}', None)
+
+    if handler:
+        asyncio.ensure_future(handler(*args))
+
+
+def parse_limit(value):
+    if value.lower() == 'none':
+        return None
+
+    limit, period = value.split('/')
+
+    return int(limit), float(period)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plays lots of runs at once against a fake Discord')
+    parser.add_argument('--runs', type=int, default=10, help='Runs played at once')
+    parser.add_argument('--runners', type=int, default=3, help='Runners on each run, besides security')
+    parser.add_argument('--cards', type=int, default=5, help='Protection cards played in each run')
+    parser.add_argument('--think-time', type=float, default=0.5, help='Most seconds a player waits before a command')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each request to Discord takes')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Seconds either way the latency varies by')
+    parser.add_argument('--route-limit', type=parse_limit, default='5/5',
+                        help='Requests per seconds on each route and channel, like 5/5, or none')
+    parser.add_argument('--global-limit', type=parse_limit, default='50/1',
+                        help='Requests per seconds over everything, like 50/1, or none')
+    parser.add_argument('--edit-window', type=float, default=None,
+                        help='Seconds to batch status edits for (defaults to STATUS_EDIT_WINDOW)')
+    parser.add_argument('--seed', type=int, default=None, help='Makes the players and latencies repeatable')
+    parser.add_argument('--output', default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.edit_window is not None:
+        run.status_editor.window = args.edit_window
+
+    random.seed(args.seed)
+    fake = fakediscord.FakeDiscord(args.latency, args.jitter, args.route_limit, args.global_limit, dispatch, args.seed)
+    load_test = LoadTest(fake, args.think_time, args.seed)
+    games = load_test.build_guild(args.runs, args.runners)
+
+    print(f'Playing {args.runs} runs of {args.runners} runners and {args.cards} cards...\n')
+    elapsed, lost = asyncio.get_event_loop().run_until_complete(load_test.play(games, args.cards))
+
+    load_test.report(elapsed, lost)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(load_test.results(elapsed, lost), output, indent=2)
+
+        print(f'\nWrote the results to {args.output}')
@@ -0,0 +1,233 @@
+# metrics.py
+"""
+Counters and latency histograms for the bot, served in Prometheus' text format and summarised by the bot-stats
+command. Covers how long each command takes, the phases of a command (fetching the pins, parsing the status, editing
+it, sending messages), the REST requests made of Discord per route, the 429s discord.py waited out, how long requests
+queued for their turn in each priority class, and anything else registered as a gauge (like the gateway latency).
+"""
+import collections
+import logging
+import math
+import re
+import time
+
+from aiohttp import web
+
+# Upper bounds, in seconds, of the histogram buckets: from a cached command up to one stuck behind rate limits
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+prefix = 'runninghot'
+
+
+class Histogram:
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        """Estimated the way Prometheus' histogram_quantile does, by interpolating within the bucket it falls in"""
+        if not self.count:
+            return math.nan
+
+        rank = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+
+            seen += count
+
+        return self.buckets[-1]
+
+
+class Timer:
+    """Times a block into a histogram: `with metrics.phase('pins'):`"""
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def labels(**values):
+    return '{' + ','.join([f'{key}="{escape(value)}"' for (key, value) in values.items()]) + '}'
+
+
+class Metrics:
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = collections.defaultdict(Histogram)
+        self.command_errors = collections.Counter()
+        self.phases = collections.defaultdict(Histogram)
+        self.requests = collections.defaultdict(Histogram)
+        self.request_errors = collections.Counter()
+        self.rate_limits = collections.Counter()
+        self.rate_limit_seconds = collections.Counter()
+        self.queue_waits = collections.defaultdict(Histogram)
+        self.gauges = {}
+
+    def phase(self, name) -> Timer:
+        return Timer(self.phases[name])
+
+    def command(self, name, seconds: float, failed: bool):
+        self.commands[name].observe(seconds)
+
+        if failed:
+            self.command_errors[name] += 1
+
+    def request(self, route: str, seconds: float, error_status=None):
+        self.requests[route].observe(seconds)
+
+        if error_status is not None:
+            self.request_errors[(route, error_status)] += 1
+
+    def rate_limited(self, route: str, retry_after: float):
+        self.rate_limits[route] += 1
+        self.rate_limit_seconds[route] += retry_after
+
+    def request_queued(self, priority: str, seconds: float):
+        self.queue_waits[priority].observe(seconds)
+
+    def gauge(self, name, help_text, read, label=None):
+        """
+        Registers a value read when the metrics are served, e.g. the gateway latency. With a label, read returns a dict
+        of values by label
+        """
+        self.gauges[name] = (help_text, read, label)
+
+    def render(self):
+        """Everything, in Prometheus' text exposition format"""
+        lines = []
+
+        def histograms(name, help_text, label, by_label):
+            lines.extend([f'# HELP {prefix}_{name} {help_text}', f'# TYPE {prefix}_{name} histogram'])
+
+            for key, histogram in sorted(by_label.items()):
+                cumulative = 0
+
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_{name}_bucket{labels(**{label: key, "le": bound})} {cumulative}')
+
+                lines.append(f'{prefix}_{name}_sum{labels(**{label: key})} {histogram.sum}')
+                lines.append(f'{prefix}_{name}_count{labels(**{label: key})} {histogram.count}')
+
+        def counter(name, help_text, values, label_names):
+            lines.extend([f'# HELP {prefix}_{name} {help_text}', f'# TYPE {prefix}_{name} counter'])
+
+            for key, value in sorted(values.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append(f'{prefix}_{name}{labels(**dict(zip(label_names, key)))} {value}')
+
+        histograms('command_duration_seconds', 'Time taken by each command', 'command', self.commands)
+        counter('command_errors_total', 'Commands that raised an error', self.command_errors, ['command'])
+        histograms(
+            'phase_duration_seconds', 'Time taken by each phase of a command: pins, parse, edit and send', 'phase',
+            self.phases
+        )
+        histograms(
+            'discord_request_duration_seconds', 'Time taken by REST requests to Discord, per route', 'route',
+            self.requests
+        )
+        counter(
+            'discord_request_errors_total', 'REST requests to Discord that failed, per route and status',
+            self.request_errors, ['route', 'status']
+        )
+        counter(
+            'discord_rate_limits_total', '429s from Discord waited out, per route path', self.rate_limits, ['route']
+        )
+        counter(
+            'discord_rate_limit_seconds_total', 'Seconds spent waiting out 429s, per route path',
+            self.rate_limit_seconds, ['route']
+        )
+
+        histograms(
+            'request_queue_seconds', 'Time REST requests waited for their turn, per priority class', 'priority',
+            self.queue_waits
+        )
+
+        for name, (help_text, read, label) in sorted(self.gauges.items()):
+            value = read()
+
+            if value is None:
+                continue
+
+            lines.extend([f'# HELP {prefix}_{name} {help_text}', f'# TYPE {prefix}_{name} gauge'])
+
+            if label:
+                lines.extend([f'{prefix}_{name}{labels(**{label: key})} {x}' for (key, x) in sorted(value.items())])
+            else:
+                lines.append(f'{prefix}_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# discord.py's bucket names end in the route's path, e.g. "None:1234:/channels/{channel_id}/messages"
+bucket_path_regex = re.compile('^[^:]*:[^:]*:(.*)$')
+
+
+class RateLimitHandler(logging.Handler):
+    """
+    Counts the 429s discord.py waits out, from the warnings it logs for them on the discord.http logger (it doesn't
+    tell us any other way)
+    """
+
+    def __init__(self, metrics: Metrics):
+        super().__init__(logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record: logging.LogRecord):
+        if not isinstance(record.args, tuple) or not record.args:
+            return
+
+        # Global rate limits log this too, before saying they're global
+        if record.msg.startswith('We are being rate limited') and len(record.args) == 2:
+            retry_after, bucket = record.args
+            match = bucket_path_regex.match(str(bucket))
+            self.metrics.rate_limited(match.group(1) if match else str(bucket), float(retry_after))
+
+
+async def serve(metrics: Metrics, host: str, port: int) -> web.AppRunner:
+    """Serves the metrics at http://host:port/metrics until the returned runner is cleaned up"""
+
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return runner
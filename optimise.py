@@ -0,0 +1,125 @@
+# optimise.py
+"""
+Works out how security should spread a boost budget across the protection cards left in a run.
+
+Each card stops the runners if their attack roll doesn't get more successes than the card's dice plus its bonus dice
+(alerts, boost and depth, as calculate-strength works them out). The best split is the one that makes it most likely
+that some card stops them before they're through, which is the same as making the chance of them beating every card
+as small as possible.
+"""
+import functools
+
+import dice
+import rules
+
+
+class BoostPlan:
+
+    def __init__(self, extra_boosts, costs, pass_chances, unboosted_pass_chances):
+        self.extra_boosts = extra_boosts
+        self.costs = costs
+        self.pass_chances = pass_chances
+        self.unboosted_pass_chances = unboosted_pass_chances
+
+    @property
+    def total_cost(self):
+        return sum(self.costs)
+
+    @staticmethod
+    def stop_chance(pass_chances):
+        through = 1.0
+
+        for chance in pass_chances:
+            through *= chance
+
+        return 1 - through
+
+    @property
+    def boosted_stop_chance(self):
+        return self.stop_chance(self.pass_chances)
+
+    @property
+    def unboosted_stop_chance(self):
+        return self.stop_chance(self.unboosted_pass_chances)
+
+
+@functools.lru_cache(maxsize=4096)
+def pass_chance(attack_dice: int, card_dice: int, sides: int, threshold: int):
+    """The chance of the runners getting more successes than the card"""
+    attacker = dice.success_distribution(attack_dice, sides, threshold)
+    defender = dice.success_distribution(card_dice, sides, threshold)
+
+    return dice.compare_distributions(attacker, defender)[0]
+
+
+def best_split(options, budget: int):
+    """
+    Where options holds, for each card, a tuple of (cost, pass chance) for each amount of extra boost, finds the
+    extra boosts within the budget that give the smallest chance of the runners beating every card. Returns that chance
+    and the extra boost for each card
+    """
+    # Best splits of what's left of the budget over the cards from each one on, for this call only
+    memo = {}
+
+    def split_from(card: int, left: int):
+        if card == len(options):
+            return 1.0, ()
+
+        if (card, left) not in memo:
+            best = None
+
+            for extra, (cost, chance) in enumerate(options[card]):
+                if cost > left:
+                    break
+
+                rest_chance, rest_boosts = split_from(card + 1, left - cost)
+                through = chance * rest_chance
+
+                if best is None or through < best[0]:
+                    best = (through, (extra,) + rest_boosts)
+
+            memo[(card, left)] = best
+
+        return memo[(card, left)]
+
+    return split_from(0, budget)
+
+
+def card_options(boost: int, base_dice: int, attack_dice: int, budget: int, sides: int, threshold: int):
+    options = []
+    extra = 0
+
+    while rules.boost_cost(boost, boost + extra) <= budget:
+        cost = rules.boost_cost(boost, boost + extra)
+        options.append((cost, pass_chance(attack_dice, base_dice + boost + extra, sides, threshold)))
+        extra += 1
+
+    return tuple(options)
+
+
+def optimise_boost(boosts, alerts: int, first_depth: int, budget: int, attack_dice: int, card_dice: int,
+                   sides: int = 8, threshold: int = 5) -> BoostPlan:
+    """
+    boosts is the boost each remaining card already has, starting with the card at first_depth
+    """
+    if budget < 0:
+        raise ValueError('The budget can\'t be negative')
+
+    alert_bonus = rules.bonus_from_alerts(alerts)
+
+    options = tuple(
+        card_options(
+            boost, card_dice + alert_bonus + rules.bonus_from_depth(first_depth + i), attack_dice, budget, sides,
+            threshold
+        )
+        for i, boost in enumerate(boosts)
+    )
+
+    _, extra_boosts = best_split(options, budget)
+
+    return BoostPlan(
+        list(extra_boosts),
+        [card[extra][0] for card, extra in zip(options, extra_boosts)],
+        [card[extra][1] for card, extra in zip(options, extra_boosts)],
+        [card[0][1] for card in options]
+    )
@@ -0,0 +1,118 @@
+# render.py
+"""
+Draws tables exactly as tabulate's "github" format does, without going through tabulate for the simple tables the bot
+uses: columns that are all whole numbers or all plain text, in scripts where every character is one column wide.
+Anything else is handed to tabulate, so the output is always the same as before.
+
+Rows and whole tables are cached, so redrawing a run status where one card changed only renders that card's row.
+"""
+import functools
+import unicodedata
+
+import tabulate
+
+# tabulate makes every column at least this much wider than its header
+header_padding = 2
+
+
+@functools.lru_cache(maxsize=None)
+def is_narrow(character):
+    """
+    Whether the character is one column wide however tabulate measures it. Sticks to Latin, Greek and Cyrillic letters
+    (which is plenty for the card names), leaving out the combining marks and invisible characters among them
+    """
+    return (ord(character) < 0x0530 or 0x1e00 <= ord(character) < 0x1f00) and unicodedata.category(character) not in (
+        'Mn', 'Me', 'Cf'
+    )
+
+
+def is_plain_text(value):
+    """Text tabulate would leave as text: printable, one column per character, and doesn't look like a number"""
+    if type(value) is not str or not value.isprintable():
+        return False
+
+    if not value.isascii() and not all(is_narrow(character) for character in value):
+        return False
+
+    try:
+        float(value)
+    except ValueError:
+        return True
+
+    return False
+
+
+@functools.lru_cache(maxsize=4096)
+def render_row(cells, widths, right_aligned):
+    return '| ' + ' | '.join([
+        cell.rjust(width) if right else cell.ljust(width)
+        for cell, width, right in zip(cells, widths, right_aligned)
+    ]) + ' |'
+
+
+@functools.lru_cache(maxsize=256)
+def render_separator(widths):
+    return '|' + '|'.join(['-' * (width + 2) for width in widths]) + '|'
+
+
+@functools.lru_cache(maxsize=4096)
+def row_cells(row):
+    """The text of each cell and whether it's a whole number, or None if tabulate needs to draw this row"""
+    cells = []
+    numbers = []
+
+    for value in row:
+        if type(value) is int:
+            cells.append(str(value))
+            numbers.append(True)
+        elif is_plain_text(value):
+            cells.append(value.strip())
+            numbers.append(False)
+        else:
+            return None
+
+    return tuple(cells), tuple(numbers)
+
+
+@functools.lru_cache(maxsize=1024)
+def render_table(rows, headers):
+    if not rows or any(len(row) != len(headers) for row in rows):
+        return None
+
+    if not all(is_plain_text(header) and header == header.strip() for header in headers if header):
+        return None
+
+    formatted = [row_cells(row) for row in rows]
+
+    if None in formatted:
+        return None
+
+    # A column mixing numbers and text is text to tabulate, so leave that to it
+    right_aligned = formatted[0][1]
+
+    if any(numbers != right_aligned for (_, numbers) in formatted):
+        return None
+
+    cells = [row for (row, _) in formatted]
+    widths = tuple(
+        max([len(header) + header_padding] + [len(row[i]) for row in cells]) for i, header in enumerate(headers)
+    )
+
+    return '\n'.join(
+        [render_row(headers, widths, right_aligned), render_separator(widths)]
+        + [render_row(row, widths, right_aligned) for row in cells]
+    )
+
+
+def github_table(rows, headers):
+    """The same as tabulate.tabulate(rows, headers, tablefmt="github")"""
+    try:
+        table = render_table(tuple(tuple(row) for row in rows), tuple(headers))
+    except TypeError:
+        # Something in the rows can't be hashed, so can't be cached either
+        table = None
+
+    if table is None:
+        table = tabulate.tabulate(rows, headers, tablefmt="github")
+
+    return table
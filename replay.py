@@ -0,0 +1,175 @@
+# replay.py
+"""
+Plays a trace written by the bot (run it with TRACE_FILE set) back through the command callbacks, against the in-memory
+Discord in fakediscord.py, at anything from the speed it was recorded at to 100 times faster. Reports each command's
+latency and the requests it made, as loadtest.py does, after what the trace recorded for the same commands.
+
+The fake guild is built from the trace: the channels the commands were typed in (with a voice channel beside each
+facility), the roles their authors had, and a member for each author. Runs start out empty, so commands in a run that
+was already going when the trace started won't find its status - trace from the start of a turn to replay a whole one.
+
+Run `python replay.py --help` for the options. Doesn't connect to Discord.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import time
+
+import fakediscord
+import loadtest
+import run
+
+
+def read_trace(path):
+    with open(path) as trace_file:
+        trace = [json.loads(line) for line in trace_file if line.strip()]
+
+    return sorted(trace, key=lambda x: x['time'])
+
+
+def build_guild(fake: fakediscord.FakeDiscord, trace):
+    """The guild the trace was recorded in, as far as the trace shows it. Returns it, its channels and its members"""
+    guild = fake.guild()
+    role_names = [run.control_role_name, 'bot-master'] + list(run.CORPORATION_ROLE_NAMES.values())
+    role_names += [name for record in trace for name in record.get('author_roles', [])]
+
+    # Run roles are made by the commands being replayed
+    roles = {name: guild.add_role(name) for name in dict.fromkeys(role_names) if not name.startswith('run-')}
+    categories = {}
+    channels = {}
+    members = {}
+
+    for record in trace:
+        category_name = record.get('category')
+
+        if category_name and category_name not in categories:
+            categories[category_name] = fakediscord.FakeCategory(guild, category_name)
+            guild.channels.append(categories[category_name])
+
+        if record['channel_id'] not in channels:
+            category = categories.get(category_name)
+            channel = fakediscord.FakeTextChannel(guild, record['channel'] or str(record['channel_id']), category)
+            guild.channels.append(channel)
+            channels[record['channel_id']] = channel
+
+            if category_name and category_name.startswith('runs-'):
+                guild.channels.append(fakediscord.FakeVoiceChannel(guild, channel.name, category))
+
+        if record['author'] not in members:
+            members[record['author']] = guild.add_member(
+                record['author'], record['author'],
+                [roles[name] for name in record.get('author_roles', []) if name in roles]
+            )
+
+    return guild, channels, members
+
+
+async def replay(load_test: loadtest.LoadTest, trace, channels, members, speed: float):
+    """Starts each command when it was started in the trace, sped up, without waiting for the ones before it"""
+    started = time.monotonic()
+    first = trace[0]['time']
+    commands = []
+
+    for record in trace:
+        delay = (record['time'] - first) / speed - (time.monotonic() - started)
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        commands.append(asyncio.ensure_future(load_test.invoke(
+            record['command'], channels[record['channel_id']], members[record['author']], *record['args'],
+            **record['kwargs']
+        )))
+
+    await asyncio.gather(*commands)
+    await run.status_editor.flush_all()
+
+    return time.monotonic() - started
+
+
+def report_recorded(trace):
+    by_command = collections.defaultdict(list)
+
+    for record in trace:
+        by_command[record['command']].append(record)
+
+    print(f'As recorded, over {trace[-1]["time"] - trace[0]["time"]:.1f}s:')
+    print(f'{"Command":<20} {"Count":>6} {"Failed":>6} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} '
+          f'{"Max ms":>9} {"Requests":>9}')
+
+    for name, records in sorted(by_command.items()):
+        latencies = sorted(x['ms'] for x in records)
+        requests = sum(len(x['requests']) for x in records)
+        print(f'{name:<20} {len(records):>6} {sum(1 for x in records if x["failed"]):>6} '
+              f'{loadtest.percentile(latencies, 50):>9.1f} {loadtest.percentile(latencies, 90):>9.1f} '
+              f'{loadtest.percentile(latencies, 99):>9.1f} {latencies[-1]:>9.1f} {requests / len(records):>9.2f}')
+
+
+def compare(results, previous_path):
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)['commands']
+
+    print(f'\nCompared with {previous_path} (below 1.00x is faster or fewer now):')
+    print(f'{"Command":<20} {"p50":>8} {"p90":>8} {"Requests":>9}')
+
+    for name, result in sorted(results['commands'].items()):
+        old = previous.get(name)
+
+        if old and old['p50_ms'] and old['p90_ms']:
+            requests = result['requests'] / old['requests'] if old['requests'] else float('nan')
+            print(f'{name:<20} {result["p50_ms"] / old["p50_ms"]:>7.2f}x {result["p90_ms"] / old["p90_ms"]:>7.2f}x '
+                  f'{requests:>8.2f}x')
+
+
+def parse_speed(value):
+    speed = float(value)
+
+    if not 1 <= speed <= 100:
+        raise argparse.ArgumentTypeError('must be from 1 to 100')
+
+    return speed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a command trace against a fake Discord')
+    parser.add_argument('trace', help='A trace written by the bot with TRACE_FILE set')
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help='How many times faster to replay it, 1 to 100')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each request to Discord takes')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Seconds either way the latency varies by')
+    parser.add_argument('--route-limit', type=loadtest.parse_limit, default='5/5',
+                        help='Requests per seconds on each route and channel, like 5/5, or none')
+    parser.add_argument('--global-limit', type=loadtest.parse_limit, default='50/1',
+                        help='Requests per seconds over everything, like 50/1, or none')
+    parser.add_argument('--seed', type=int, default=None, help='Makes the latencies repeatable')
+    parser.add_argument('--output', default=None, help='Also write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Results from an earlier replay to compare with')
+    args = parser.parse_args()
+
+    trace = [x for x in read_trace(args.trace) if run.bot.get_command(x['command'])]
+
+    if not trace:
+        parser.error(f'No commands this bot knows in {args.trace}')
+
+    fake = fakediscord.FakeDiscord(
+        args.latency, args.jitter, args.route_limit, args.global_limit, loadtest.dispatch, args.seed
+    )
+    load_test = loadtest.LoadTest(fake, 0, args.seed)
+    load_test.guild, channels, members = build_guild(fake, trace)
+
+    report_recorded(trace)
+
+    print(f'\nReplaying {len(trace)} commands at {args.speed:g}x...\n')
+    elapsed = asyncio.get_event_loop().run_until_complete(replay(load_test, trace, channels, members, args.speed))
+
+    load_test.report(elapsed, [])
+    results = load_test.results(elapsed, [])
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(dict(results, trace=args.trace, speed=args.speed), output, indent=2)
+
+        print(f'\nWrote the results to {args.output}')
+
+    if args.compare:
+        compare(results, args.compare)
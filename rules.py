@@ -0,0 +1,32 @@
+# rules.py
+import math
+
+RUNNER_ALERTS = {
+    0: 0,
+    1: 0,
+    2: 1,
+    3: 2,
+    4: 4,
+    5: 7,
+    6: 11
+}
+
+
+def alerts_for_runners(num_runners):
+    if num_runners in RUNNER_ALERTS:
+        return RUNNER_ALERTS[num_runners]
+
+    return ((num_runners * (num_runners + 1)) / 2) - 10
+
+
+def bonus_from_alerts(alerts):
+    return math.floor(-0.5 + math.sqrt(0.5 * 0.5 - (4 * 0.5 * (0 - alerts))))
+
+
+def bonus_from_depth(current_depth):
+    return math.floor(current_depth / 2)
+
+
+def boost_cost(old_boost, new_boost):
+    """What security pays to take a card from old_boost to new_boost - each extra point costs its new total"""
+    return sum(range(old_boost + 1, new_boost + 1))
@@ -1,34 +1,199 @@
 # bot.py
+import asyncio
+import base64
+import collections
+import cProfile
+import contextvars
+import copy
 import datetime
+import functools
+import heapq
+import io
+import itertools
 import json
+import logging
 import math
 import os
+import pstats
 import random
 import re
+import sqlite3
+import time
+import zlib
 from typing import Optional
 
+import aiohttp
 import discord
-import tabulate
+from aiohttp import web
 from discord.ext import commands
 from dotenv import load_dotenv
 
+import dice
+import metrics
+import optimise
+import render
+import rules
+import simulate
+
 intents = discord.Intents.default()
 intents.members = True
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 
-with open('cards.json') as cards:
-    CARD_LIST = json.load(cards)
+
+def read_card_catalogue():
+    """Reads cards.json, and when each card's image last changed (cards with no image are left out of the times)"""
+    with open('cards.json') as cards:
+        card_list = json.load(cards)
+
+    image_times = {}
+
+    for card_id in card_list:
+        path = os.path.join('card-images', f'{card_id}.png')
+
+        if os.path.exists(path):
+            image_times[card_id] = os.path.getmtime(path)
+
+    return card_list, image_times
+
+
+CARD_LIST, card_image_times = read_card_catalogue()
 
 command_prefix = os.getenv('COMMAND_PREFIX', '!')
-bot = commands.Bot(command_prefix=command_prefix, intents=intents)
+
+dice_success_threshold = int(os.getenv('DICE_SUCCESS_THRESHOLD', '5'))
+dice_detail_limit = int(os.getenv('DICE_DETAIL_LIMIT', '100'))
+dice_max = int(os.getenv('DICE_MAX', '100000'))
+dice_max_sides = int(os.getenv('DICE_MAX_SIDES', '1000'))
+dice_echo_limit = 200
+odds_max_dice = int(os.getenv('ODDS_MAX_DICE', '1000'))
+simulate_max_trials = int(os.getenv('SIMULATE_MAX_TRIALS', '1000000'))
+simulate_workers = int(os.getenv('SIMULATE_WORKERS', '1'))
+simulate_max_cards = int(os.getenv('SIMULATE_MAX_CARDS', '100'))
+simulate_max_dice = int(os.getenv('SIMULATE_MAX_DICE', '100'))
+simulate_max_runners = int(os.getenv('SIMULATE_MAX_RUNNERS', '50'))
+simulate_max_budget = int(os.getenv('SIMULATE_MAX_BUDGET', '1000'))
+optimise_max_budget = int(os.getenv('OPTIMISE_MAX_BUDGET', '100'))
+optimise_max_dice = int(os.getenv('OPTIMISE_MAX_DICE', '50'))
+
+dice.precompute_distributions([6, 8], 50, dice_success_threshold)
+
+
+bot_metrics = metrics.Metrics()
+
+
+class RunningHotContext(commands.Context):
+    """Times the messages commands send"""
+
+    async def send(self, content=None, **kwargs):
+        with bot_metrics.phase('send'):
+            return await super().send(content, **kwargs)
+
+    async def reply(self, content=None, **kwargs):
+        with bot_metrics.phase('send'):
+            return await super().reply(content, **kwargs)
+
+
+class RunningHotBot(commands.Bot):
+
+    async def get_context(self, message, *, cls=RunningHotContext):
+        return await super().get_context(message, cls=cls)
+
+    async def close(self):
+        # Don't lose status changes that are still waiting to be written to the pinned messages
+        await status_editor.flush_all()
+
+        if card_attachments.session:
+            await card_attachments.session.close()
+
+        if command_tracer:
+            command_tracer.close()
+
+        if metrics_server:
+            await metrics_server.cleanup()
+
+        await super().close()
+
+
+bot = RunningHotBot(command_prefix=command_prefix, intents=intents)
 
 group_regex = re.compile('Runner Group (\\d+): (.+)')
 defenders_regex = re.compile('Defenders: (.+)')
 alert_regex = re.compile('Alerts: (\d+).* \\(\\+\\d+\\)')
 active_group_regex = re.compile('Defending facility from group (\\d+)')
 
+# Marks the machine-readable copy of the run status kept in the status message's embed footer. Bump the version if the
+# payload's layout changes, and keep reading the old one. Payloads too long for a footer are compressed and base64'd
+status_payload_prefix = 'rh1:'
+compressed_status_payload_prefix = 'rh1z:'
+embed_footer_limit = 2048
+
+# Statuses too long for one message carry on over more pinned messages, each after the first starting with its number
+status_message_limit = 2000
+status_title = '`!!! Run status !!!`'
+status_page_marker = '`!!! Run status (page {}) !!!`'
+
+
+def page_embed(footer):
+    return discord.Embed().set_footer(text=footer) if footer else None
+
+
+def status_page_number(content):
+    if content.startswith(status_title):
+        return 1
+
+    prefix = status_page_marker.split('{}')[0]
+
+    if content.startswith(prefix):
+        number = content[len(prefix):].split(')', 1)[0]
+        return int(number) if number.isdigit() else None
+
+    return None
+
+
+def split_status(header, table):
+    """
+    Spreads a status over as many pages as it needs, keeping whole lines together. Each page the card table carries on
+    to gets its own code block with the table's heading repeated
+    """
+    pages = []
+    page = ''
+
+    def next_page():
+        pages.append(page)
+        return status_page_marker.format(len(pages) + 1)
+
+    for line in header.rstrip('\n').split('\n'):
+        if len(page) + len(line) + 1 > status_message_limit:
+            page = next_page()
+
+        page = f'{page}\n{line}' if page else line
+
+    if table:
+        lines = table.split('\n')
+        heading, rows = lines[:2], lines[2:]
+        page_rows = []
+
+        def block(block_rows):
+            return '```\n{}\n```'.format('\n'.join(heading + block_rows))
+
+        for row in rows:
+            if len(page) + len(block(page_rows + [row])) + 1 > status_message_limit:
+                if page_rows:
+                    page = f'{page}\n{block(page_rows)}'
+
+                page = next_page()
+                page_rows = []
+
+            page_rows.append(row)
+
+        page = f'{page}\n{block(page_rows)}'
+
+    pages.append(page)
+
+    return pages
+
 
 class Group:
 
@@ -74,48 +239,143 @@ class RunStatus:
         self.active_group_obj = None
 
     def __str__(self):
-        defenders = ', '.join([f'`{x}`' for x in self.defenders])
-
-        defenders = f"\nDefenders: {defenders}" if defenders else ''
+        table = self.card_table()
 
-        alert_bonus = self.bonus_from_alerts(self.alerts)
+        return self.status_header() + ('```\n{}\n```'.format(table) if table else '')
 
+    def status_header(self):
+        """Everything in the status above the card table"""
         self.groups.sort(key=lambda x: x.group_num)
 
-        groups = '\n'.join([str(x) for x in list(filter(lambda group: group.runners, self.groups))])
-
-        protection_cards = []
-
-        for i, card in enumerate(self.protection_cards):
-            prefix = ' -> ' if i == self.current_depth else ''
-            protection_cards.append(
-                [prefix, card.card_id, card.card_name, card.boost]
-            )
-
-        if protection_cards:
-            formatted_cards = '```\n{}\n```'.format(
-                tabulate.tabulate(protection_cards, ["", "Card ID", "Card name", "Boost"], tablefmt="github")
-            )
-        else:
-            formatted_cards = ''
+        # Each section is cached on what's in it, so only the parts of the status that changed get rendered again
+        groups = render_groups(tuple((group.group_num, tuple(group.runners)) for group in self.groups))
+        defenders = render_defenders(tuple(self.defenders))
 
         active_group = f"\nDefending facility from group {self.active_group}" if self.active_group else ''
 
-        return "`!!! Run status !!!`\n{}{}{}\nAlerts: {} (+{})\n{}".format(
+        return "{}\n{}{}{}\nAlerts: {} (+{})\n".format(
+            status_title,
             groups,
             defenders,
             active_group,
             self.alerts,
-            alert_bonus,
-            formatted_cards
+            self.bonus_from_alerts(self.alerts)
+        )
+
+    def card_table(self):
+        return render_protection_cards(
+            tuple((card.card_id, card.card_name, card.boost) for card in self.protection_cards),
+            self.current_depth
         )
 
+    def pages(self):
+        """
+        The status as the (content, embed footer) of each pinned message it's posted as. A status that fits in one
+        message is exactly str(self), and the payload is split across the footers if it's too long for one
+        """
+        header = self.status_header()
+        table = self.card_table()
+        content = header + ('```\n{}\n```'.format(table) if table else '')
+
+        contents = [content] if len(content) <= status_message_limit else split_status(header, table)
+
+        payload = self.to_payload()
+        footers = [payload[i:i + embed_footer_limit] for i in range(0, len(payload), embed_footer_limit)]
+
+        while len(contents) < len(footers):
+            contents.append(status_page_marker.format(len(contents) + 1))
+
+        return [(page, footers[i] if i < len(footers) else '') for i, page in enumerate(contents)]
+
     @staticmethod
     def bonus_from_alerts(alerts):
-        return math.floor(-0.5 + math.sqrt(0.5 * 0.5 - (4 * 0.5 * (0 - alerts))))
+        return rules.bonus_from_alerts(alerts)
+
+    @staticmethod
+    def bonus_from_depth(current_depth):
+        return rules.bonus_from_depth(current_depth)
+
+    def total_bonus_dice(self):
+        active_card = self.get_active_card()
+
+        return self.bonus_from_alerts(self.alerts) + active_card.boost + self.bonus_from_depth(self.current_depth)
+
+    def to_payload(self):
+        """The whole status as compact JSON, to go in the status message's embed footer"""
+        state = {
+            'g': [[group.group_num, group.runners] for group in self.groups],
+            'a': self.alerts,
+            'd': self.current_depth,
+            'c': [[card.card_id, card.card_name, card.boost] for card in self.protection_cards],
+            'f': self.defenders,
+            'ag': self.active_group
+        }
+        payload = status_payload_prefix + json.dumps(state, separators=(',', ':'))
+
+        if len(payload) > embed_footer_limit:
+            data = zlib.compress(payload[len(status_payload_prefix):].encode(), 9)
+            payload = compressed_status_payload_prefix + base64.b64encode(data).decode()
+
+        return payload
+
+    @classmethod
+    def from_payload(cls, payload: str):
+        try:
+            if payload.startswith(status_payload_prefix):
+                state = json.loads(payload[len(status_payload_prefix):])
+            elif payload.startswith(compressed_status_payload_prefix):
+                state = json.loads(zlib.decompress(base64.b64decode(payload[len(compressed_status_payload_prefix):])))
+            else:
+                raise ValueError('Not a run status payload')
+        except (ValueError, zlib.error) as error:
+            raise ValueError(f'Couldn\'t read the run status payload: {error}')
+
+        return RunStatus(
+            groups=[Group(group_num, runners) for (group_num, runners) in state['g']],
+            alerts=state['a'],
+            current_depth=state['d'],
+            defenders=state['f'],
+            protection_cards=[ProtectionCard(card_id, card_name, boost) for (card_id, card_name, boost) in state['c']],
+            active_group=state['ag']
+        )
+
+    @staticmethod
+    def payload_from_messages(messages):
+        footers = []
+
+        for message in messages:
+            text = getattr(message.embeds[0].footer, 'text', None) if message.embeds else None
+
+            if isinstance(text, str):
+                footers.append(text)
+
+        payload = ''.join(footers)
+
+        if payload.startswith((status_payload_prefix, compressed_status_payload_prefix)):
+            return payload
+
+        return None
 
     @classmethod
     def from_message(cls, message: discord.Message):
+        return cls.from_messages([message])
+
+    @classmethod
+    def from_messages(cls, messages):
+        """Reads the status back from the pages it was posted as, in order"""
+        payload = cls.payload_from_messages(messages)
+
+        if payload:
+            try:
+                return cls.from_payload(payload)
+            except ValueError as error:
+                print(f'Falling back to reading the run status text in message {messages[0].id}: {error.args[0]}')
+
+        return cls.from_text('\n'.join([message.content for message in messages]))
+
+    @classmethod
+    def from_text(cls, content: str):
+        """Reads the status back out of the message text, for status messages from before the payload was added"""
         groups = []
         defenders = []
         alerts = 0
@@ -123,8 +383,8 @@ class RunStatus:
         protection_cards = []
         active_group = None
 
-        for line in message.content.split('\n'):
-            if line == '`!!! Run status !!!`':
+        for line in content.split('\n'):
+            if line == status_title:
                 continue
 
             match = group_regex.match(line)
@@ -155,21 +415,18 @@ class RunStatus:
             if line == '```':
                 break
 
-        # Find the table
-        split = message.content.split('```')
-
-        if len(split) > 1:
-            table = split[1]
+        # Find the table, which carries on through every code block when the status is spread over several pages
+        for table in content.split('```')[1::2]:
             rows = table.split("\n")
 
-            for i, row in enumerate(rows[3:-1]):
+            for row in rows[3:-1]:
                 cols = row.split('|')
                 card_id = cols[2].strip()
                 card_name = cols[3].strip()
                 card_boost = int(cols[4].strip())
 
                 if cols[1].strip() == '->':
-                    current_depth = i
+                    current_depth = len(protection_cards)
 
                 protection_cards.append(ProtectionCard(card_id, card_name, card_boost))
 
@@ -204,20 +461,7 @@ class RunStatus:
 
         num_runners = len(active_group.runners)
 
-        mapping = {
-            0: 0,
-            1: 0,
-            2: 1,
-            3: 2,
-            4: 4,
-            5: 7,
-            6: 11
-        }
-
-        if num_runners in mapping:
-            return num_runners, mapping[num_runners]
-
-        return num_runners, ((num_runners * (num_runners + 1)) / 2) - 10
+        return num_runners, rules.alerts_for_runners(num_runners)
 
     def get_active_group(self):
         if self.active_group_obj is None or self.active_group_obj.group_num != self.active_group:
@@ -228,27 +472,1375 @@ class RunStatus:
                     self.active_group_obj = group
                     return group
 
-            raise ValueError('Couldn\'t find group with number {}'.format(group_num))
+            raise ValueError('Couldn\'t find group with number {}'.format(group_num))
+
+        return self.active_group_obj
+
+    def add_card(self, card_id):
+        card_name = CARD_LIST[card_id]
+        self.protection_cards.append(ProtectionCard(card_id=card_id, card_name=card_name, boost=0))
+
+    def get_active_card(self):
+        if self.current_depth < 0 or self.current_depth >= len(self.protection_cards):
+            raise ValueError(f'Unknown active card - do you need to run {command_prefix}next-card?')
+
+        return self.protection_cards[self.current_depth]
+
+
+@functools.lru_cache(maxsize=1024)
+def render_groups(groups):
+    return '\n'.join([str(Group(group_num, list(runners))) for (group_num, runners) in groups if runners])
+
+
+@functools.lru_cache(maxsize=1024)
+def render_defenders(defenders):
+    defenders = ', '.join([f'`{x}`' for x in defenders])
+
+    return f"\nDefenders: {defenders}" if defenders else ''
+
+
+@functools.lru_cache(maxsize=1024)
+def render_protection_cards(cards, current_depth):
+    if not cards:
+        return ''
+
+    protection_cards = [
+        [' -> ' if i == current_depth else '', card_id, card_name, boost]
+        for i, (card_id, card_name, boost) in enumerate(cards)
+    ]
+
+    return render.github_table(protection_cards, ["", "Card ID", "Card name", "Boost"])
+
+
+class CachedRun:
+
+    def __init__(self, message: discord.Message, status: RunStatus):
+        self.message = message
+        self.status = status
+        self.pages = status.pages()
+        self.content = self.pages[0][0]
+
+
+class RunStatusCache:
+    """
+    Keeps the parsed status of every run channel we've seen, so commands don't need to fetch the pins and parse the
+    status message each time. Kept up to date by the message edit/delete and pin events below.
+
+    Each channel's generation goes up whenever its status is stored or thrown away, so a command that read the status
+    from Discord can tell whether a newer one turned up while it was reading
+    """
+
+    def __init__(self):
+        self.runs = {}
+        self.generations = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, channel_id) -> Optional[CachedRun]:
+        cached = self.runs.get(channel_id)
+
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return cached
+
+    def generation(self, channel_id) -> int:
+        return self.generations[channel_id]
+
+    def store(self, channel_id, message: discord.Message, status: RunStatus) -> CachedRun:
+        cached = CachedRun(message, copy.deepcopy(status))
+        self.runs[channel_id] = cached
+        self.generations[channel_id] += 1
+
+        return cached
+
+    def invalidate(self, channel_id):
+        self.runs.pop(channel_id, None)
+        self.generations[channel_id] += 1
+
+    def invalidate_message(self, channel_id, message_id):
+        cached = self.runs.get(channel_id)
+
+        if cached and cached.message.id == message_id:
+            self.invalidate(channel_id)
+
+
+run_cache = RunStatusCache()
+
+
+class RunStore:
+    """
+    Optional SQLite copy of every run, so the pinned message is only ever rendered from it and never read back. Turned
+    on by setting RUN_STORE_PATH
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS runs (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            alerts INTEGER NOT NULL,
+            current_depth INTEGER NOT NULL,
+            active_group INTEGER,
+            PRIMARY KEY (guild_id, channel_id)
+        );
+        CREATE TABLE IF NOT EXISTS run_groups (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            group_num INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            runner TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS run_defenders (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            defender TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS protection_cards (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            card_id TEXT NOT NULL,
+            card_name TEXT NOT NULL,
+            boost INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS run_pages (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            message_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS run_groups_run ON run_groups (guild_id, channel_id);
+        CREATE INDEX IF NOT EXISTS run_defenders_run ON run_defenders (guild_id, channel_id);
+        CREATE INDEX IF NOT EXISTS protection_cards_run ON protection_cards (guild_id, channel_id);
+        CREATE INDEX IF NOT EXISTS run_pages_run ON run_pages (guild_id, channel_id);
+    '''
+
+    child_tables = ['run_groups', 'run_defenders', 'protection_cards']
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.schema)
+
+    def load(self, guild_id, channel_id):
+        key = (guild_id, channel_id)
+
+        run = self.connection.execute(
+            'SELECT message_id, alerts, current_depth, active_group FROM runs WHERE guild_id = ? AND channel_id = ?',
+            key
+        ).fetchone()
+
+        if not run:
+            return None
+
+        message_id, alerts, current_depth, active_group = run
+
+        groups = {}
+        for group_num, runner in self.connection.execute(
+                'SELECT group_num, runner FROM run_groups WHERE guild_id = ? AND channel_id = ? '
+                'ORDER BY group_num, position',
+                key
+        ):
+            groups.setdefault(group_num, Group(group_num)).add_runner(runner)
+
+        defenders = [
+            defender for (defender,) in self.connection.execute(
+                'SELECT defender FROM run_defenders WHERE guild_id = ? AND channel_id = ? ORDER BY position',
+                key
+            )
+        ]
+
+        protection_cards = [
+            ProtectionCard(card_id, card_name, boost) for (card_id, card_name, boost) in self.connection.execute(
+                'SELECT card_id, card_name, boost FROM protection_cards WHERE guild_id = ? AND channel_id = ? '
+                'ORDER BY position',
+                key
+            )
+        ]
+
+        return message_id, RunStatus(
+            groups=list(groups.values()),
+            alerts=alerts,
+            current_depth=current_depth,
+            defenders=defenders,
+            protection_cards=protection_cards,
+            active_group=active_group
+        )
+
+    def save(self, guild_id, channel_id, message_id, status: RunStatus):
+        key = (guild_id, channel_id)
+
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO runs (guild_id, channel_id, message_id, alerts, current_depth, active_group) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (*key, message_id, status.alerts, status.current_depth, status.active_group)
+            )
+
+            for table in self.child_tables:
+                self.connection.execute(f'DELETE FROM {table} WHERE guild_id = ? AND channel_id = ?', key)
+
+            self.connection.executemany(
+                'INSERT INTO run_groups (guild_id, channel_id, group_num, position, runner) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (*key, group.group_num, position, runner)
+                    for group in status.groups
+                    for position, runner in enumerate(group.runners)
+                ]
+            )
+            self.connection.executemany(
+                'INSERT INTO run_defenders (guild_id, channel_id, position, defender) VALUES (?, ?, ?, ?)',
+                [(*key, position, defender) for position, defender in enumerate(status.defenders)]
+            )
+            self.connection.executemany(
+                'INSERT INTO protection_cards (guild_id, channel_id, position, card_id, card_name, boost) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (*key, position, card.card_id, card.card_name, card.boost)
+                    for position, card in enumerate(status.protection_cards)
+                ]
+            )
+
+    def set_message(self, guild_id, channel_id, message_id):
+        with self.connection:
+            self.connection.execute(
+                'UPDATE runs SET message_id = ? WHERE guild_id = ? AND channel_id = ?',
+                (message_id, guild_id, channel_id)
+            )
+
+    def load_pages(self, guild_id, channel_id):
+        """The message IDs of the status pages after the first, for runs too long for one message"""
+        return [
+            message_id for (message_id,) in self.connection.execute(
+                'SELECT message_id FROM run_pages WHERE guild_id = ? AND channel_id = ? ORDER BY position',
+                (guild_id, channel_id)
+            )
+        ]
+
+    def set_pages(self, guild_id, channel_id, message_ids):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM run_pages WHERE guild_id = ? AND channel_id = ?', (guild_id, channel_id)
+            )
+            self.connection.executemany(
+                'INSERT INTO run_pages (guild_id, channel_id, position, message_id) VALUES (?, ?, ?, ?)',
+                [(guild_id, channel_id, position, message_id) for position, message_id in enumerate(message_ids)]
+            )
+
+    def delete_guild(self, guild_id):
+        with self.connection:
+            for table in ['runs', 'run_pages'] + self.child_tables:
+                self.connection.execute(f'DELETE FROM {table} WHERE guild_id = ?', (guild_id,))
+
+
+run_store = RunStore(os.getenv('RUN_STORE_PATH')) if os.getenv('RUN_STORE_PATH') else None
+
+
+class PendingEdit:
+
+    def __init__(self, channel: discord.TextChannel, message: discord.Message, pages):
+        self.channel = channel
+        self.message = message
+        self.pages = pages
+
+
+class StatusEditor:
+    """
+    Write-behind editor for the pinned status messages. Changes to a run are queued here, and everything that happens in
+    the same channel within STATUS_EDIT_WINDOW seconds goes out as a single edit of the pinned message. Statuses too
+    long for one message are kept on several pinned pages, and only the pages that changed are edited
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.pending = {}
+        self.locks = {}
+        self.last_sent = {}
+        self.extra_pages = {}
+        self.requested = 0
+        self.issued = 0
+        self.pages_edited = 0
+        self.pages_unchanged = 0
+
+    @property
+    def saved(self):
+        return self.requested - self.issued - len(self.pending)
+
+    async def schedule(self, channel: discord.TextChannel, message: discord.Message, pages):
+        self.requested += 1
+
+        already_pending = channel.id in self.pending
+        self.pending[channel.id] = PendingEdit(channel, message, pages)
+
+        if self.window <= 0:
+            await self.flush(channel.id)
+        elif not already_pending:
+            asyncio.ensure_future(self.flush_later(channel.id))
+
+    async def flush_later(self, channel_id):
+        await asyncio.sleep(self.window)
+
+        try:
+            await self.flush(channel_id)
+        except discord.DiscordException as error:
+            print(f'Failed to update the run status in channel {channel_id}: {error}')
+
+    async def flush(self, channel_id):
+        lock = self.locks.setdefault(channel_id, asyncio.Lock())
+
+        # Hold the lock while editing, so a slow edit can't land after a newer one
+        async with lock:
+            pending: PendingEdit = self.pending.pop(channel_id, None)
+
+            if not pending:
+                return
+
+            self.issued += 1
+            previous = self.last_sent.get(channel_id, [])
+            self.last_sent[channel_id] = pending.pages
+
+            try:
+                await self.write_pages(pending, previous)
+            except discord.DiscordException:
+                # We don't know what made it out, so edit every page next time
+                self.last_sent.pop(channel_id, None)
+                raise
+
+    async def write_pages(self, pending: PendingEdit, previous):
+        channel = pending.channel
+        messages = [pending.message] + self.extra_pages.get(channel.id, [])
+
+        for i, (content, footer) in enumerate(pending.pages):
+            if i < len(messages) and i < len(previous) and previous[i] == (content, footer):
+                self.pages_unchanged += 1
+                continue
+
+            self.pages_edited += 1
+
+            if i >= len(messages):
+                messages.append(await self.send_page(channel, content, footer))
+                continue
+
+            try:
+                with bot_metrics.phase('edit'):
+                    await messages[i].edit(content=content, embed=page_embed(footer))
+            except discord.NotFound:
+                if i == 0 and not run_store:
+                    raise
+
+                # The store (or the first page) still knows the run, so put a fresh page up in place of the missing one
+                messages[i] = await self.send_page(channel, content, footer)
+
+                if i == 0:
+                    self.replace_first_page(pending, messages[0])
+
+        for message in messages[len(pending.pages):]:
+            try:
+                await message.delete()
+            except discord.NotFound:
+                pass
+
+        extra_pages = messages[1:len(pending.pages)]
+
+        if [x.id for x in extra_pages] != [x.id for x in self.extra_pages.get(channel.id, [])] and run_store:
+            run_store.set_pages(channel.guild.id, channel.id, [x.id for x in extra_pages])
+
+        self.extra_pages[channel.id] = extra_pages
+
+    @staticmethod
+    async def send_page(channel: discord.TextChannel, content, footer):
+        message = await channel.send(content, embed=page_embed(footer))
+        await message.pin()
+
+        return message
+
+    def replace_first_page(self, pending: PendingEdit, message: discord.Message):
+        channel = pending.channel
+        pending.message = message
+
+        run_store.set_message(channel.guild.id, channel.id, message.id)
+
+        cached = run_cache.runs.get(channel.id)
+        if cached:
+            cached.message = message
+
+        if channel.id in self.pending:
+            self.pending[channel.id].message = message
+
+    def found_pages(self, channel_id, extra_pages):
+        """Remembers the pages after the first for a run read back from its pins or the store, unless we know better"""
+        self.extra_pages.setdefault(channel_id, extra_pages)
+
+    def forget(self, channel_id):
+        for state in [self.pending, self.locks, self.last_sent, self.extra_pages]:
+            state.pop(channel_id, None)
+
+    async def flush_all(self):
+        await asyncio.gather(*[self.flush(channel_id) for channel_id in list(self.pending)])
+
+    def sent_by_us(self, channel_id, content):
+        pages = self.last_sent.get(channel_id)
+
+        return bool(pages) and content == pages[0][0]
+
+
+status_editor = StatusEditor(float(os.getenv('STATUS_EDIT_WINDOW', '1.0')))
+
+
+class RunActor:
+    """
+    Works through the queued commands for one run channel one at a time, so two commands can't both read the status,
+    change it and write it back over each other. Different channels each have their own actor and run in parallel
+    """
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.queue = asyncio.Queue()
+        self.worker: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self):
+        return self.queue.qsize() + (1 if self.worker and not self.worker.done() else 0)
+
+    async def submit(self, job):
+        future = asyncio.get_event_loop().create_future()
+        # The job runs with the submitter's context variables, so its requests are still traced to its own command
+        self.queue.put_nowait((job, future, contextvars.copy_context()))
+
+        if not self.worker or self.worker.done():
+            self.worker = asyncio.ensure_future(self.work())
+
+        return await future
+
+    async def work(self):
+        while not self.queue.empty():
+            job, future, context = self.queue.get_nowait()
+
+            try:
+                result = await context.run(asyncio.ensure_future, job())
+            except Exception as error:
+                if not future.cancelled():
+                    future.set_exception(error)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+
+class RunActors:
+
+    def __init__(self):
+        self.actors = {}
+
+    def get(self, channel_id) -> RunActor:
+        if channel_id not in self.actors:
+            self.actors[channel_id] = RunActor(channel_id)
+
+        return self.actors[channel_id]
+
+    def remove(self, channel_id):
+        self.actors.pop(channel_id, None)
+
+    def depths(self):
+        return {channel_id: actor.depth for (channel_id, actor) in self.actors.items()}
+
+
+run_actors = RunActors()
+
+
+def one_at_a_time_per_run(command):
+    """Queues the command behind any others already running in the same channel"""
+
+    @functools.wraps(command)
+    async def wrapper(ctx, *args, **kwargs):
+        return await run_actors.get(ctx.channel.id).submit(lambda: command(ctx, *args, **kwargs))
+
+    return wrapper
+
+
+# The REST requests made so far by the command being run, if any
+traced_requests = contextvars.ContextVar('traced_requests', default=None)
+
+
+def trace_value(value):
+    return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
+
+class CommandTracer:
+    """
+    Writes every command the bot runs to a JSONL trace, one line each: the command and its arguments, the channel and
+    author, when it started and how long it took, and the REST requests it made while it ran with how long each took
+    (including any wait for rate limits). replay.py plays a trace back against a stand-in for Discord
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        self.traced = 0
+
+    def record(self, ctx: commands.context.Context, seconds: float):
+        self.file.write(json.dumps({
+            'time': ctx.started_at,
+            'command': ctx.command.qualified_name,
+            'args': [trace_value(x) for x in ctx.args[1:]],
+            'kwargs': {key: trace_value(value) for (key, value) in ctx.kwargs.items()},
+            'content': ctx.message.content,
+            'guild_id': ctx.guild.id if ctx.guild else None,
+            'channel': getattr(ctx.channel, 'name', None),
+            'channel_id': ctx.channel.id,
+            'category': ctx.channel.category.name if getattr(ctx.channel, 'category', None) else None,
+            'author': getattr(ctx.author, 'nick', None) or ctx.author.name,
+            'author_roles': [role.name for role in getattr(ctx.author, 'roles', [])[1:]],
+            'ms': round(seconds * 1000, 3),
+            'failed': ctx.command_failed,
+            'requests': ctx.requests,
+        }) + '\n')
+        self.file.flush()
+        self.traced += 1
+
+    def close(self):
+        self.file.close()
+
+
+command_tracer = CommandTracer(os.getenv('TRACE_FILE')) if os.getenv('TRACE_FILE') else None
+
+
+# Which class of work the REST requests being made are for, most urgent first. Everything's interactive unless a
+# command is marked as background work with @background_priority
+request_priorities = ['interactive', 'background']
+request_priority = contextvars.ContextVar('request_priority', default='interactive')
+
+
+def background_priority(command):
+    """Sends the command's requests to Discord behind those of interactive commands and status edits"""
+
+    @functools.wraps(command)
+    async def wrapper(*args, **kwargs):
+        token = request_priority.set('background')
+
+        try:
+            return await command(*args, **kwargs)
+        finally:
+            request_priority.reset(token)
+
+    return wrapper
+
+
+class PriorityGate:
+    """Lets `limit` holders through at once, and hands each freed place to the most urgent waiter, then the oldest"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.held = 0
+        self.waiting = []
+        self.order = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self.held < self.limit and not self.waiting:
+            self.held += 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.order), future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled just after being handed a place, so pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.held -= 1
+
+
+class RequestScheduler:
+    """
+    Orders the bot's REST requests to Discord by priority. Requests in the same rate limit bucket go out one at a time,
+    as discord.py sends them anyway, but the most urgent first rather than first come first served. Background requests
+    also have to get one of a few places shared across every bucket, so bulk clean up can't take over the global rate
+    limit while players are waiting on their replies
+    """
+
+    def __init__(self, background_slots: int):
+        self.buckets = {}
+        self.background = PriorityGate(background_slots)
+        self.waiting = collections.Counter()
+
+    def install(self, http):
+        request = http.request
+
+        async def scheduled_request(route, **kwargs):
+            return await self.send(route, lambda: request(route, **kwargs))
+
+        http.request = scheduled_request
+
+    async def send(self, route, send):
+        priority = request_priority.get()
+        rank = request_priorities.index(priority)
+        background = priority != request_priorities[0]
+        queued = time.perf_counter()
+        self.waiting[priority] += 1
+
+        try:
+            # Background requests take their shared place first, so they never hold up a bucket while waiting for one
+            if background:
+                await self.background.acquire(rank)
+
+            bucket = self.buckets.setdefault(route.bucket, PriorityGate(1))
+
+            try:
+                await bucket.acquire(rank)
+            except asyncio.CancelledError:
+                if background:
+                    self.background.release()
+                raise
+        finally:
+            self.waiting[priority] -= 1
+
+        bot_metrics.request_queued(priority, time.perf_counter() - queued)
+
+        try:
+            return await send()
+        finally:
+            bucket.release()
+
+            if background:
+                self.background.release()
+
+            if not bucket.held and not bucket.waiting:
+                self.buckets.pop(route.bucket, None)
+
+
+request_scheduler = RequestScheduler(int(os.getenv('BACKGROUND_REQUEST_SLOTS', '2')))
+
+
+def instrument_http(http):
+    """
+    Wraps discord.py's HTTP client so each REST request is timed into the metrics, and added to the requests of the
+    command that made it for the trace and the profiler. The time includes any wait for rate limits
+    """
+    request = http.request
+
+    async def instrumented_request(route, **kwargs):
+        started = time.perf_counter()
+        error_status = None
+
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as error:
+            error_status = error.status
+            raise
+        finally:
+            route_name = f'{route.method} {route.path}'
+            seconds = time.perf_counter() - started
+            bot_metrics.request(route_name, seconds, error_status)
+            requests = traced_requests.get()
+
+            if requests is not None:
+                requests.append({'route': route_name, 'ms': round(seconds * 1000, 3), 'error': error_status})
+
+    http.request = instrumented_request
+
+
+request_scheduler.install(bot.http)
+instrument_http(bot.http)
+logging.getLogger('discord.http').addHandler(metrics.RateLimitHandler(bot_metrics))
+
+
+class CommandProfiler:
+    """
+    Runs cProfile over the whole bot for a while, and notes every command that finishes meanwhile with how much of its
+    time went on REST requests, so slow commands can be told apart from slow code. Saves each profile to PROFILE_DIR
+    for a closer look with pstats or snakeviz
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profile: Optional[cProfile.Profile] = None
+        self.commands = []
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    async def run(self, seconds: float):
+        """Profiles for the given time, then returns the report and where the raw profile was saved"""
+        self.profile = cProfile.Profile()
+        self.commands = []
+        self.profile.enable()
+
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.profile.disable()
+            profile, self.profile = self.profile, None
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, datetime.datetime.utcnow().strftime('profile-%Y%m%d-%H%M%S.prof'))
+        profile.dump_stats(path)
+
+        return self.report(profile, seconds), path
+
+    def command(self, ctx: commands.context.Context, seconds: float):
+        if self.active:
+            self.commands.append((
+                seconds, ctx.command.qualified_name, getattr(ctx.channel, 'name', ctx.channel.id),
+                len(ctx.requests), sum(x['ms'] for x in ctx.requests) / 1000
+            ))
+
+    def report(self, profile: cProfile.Profile, seconds: float):
+        output = io.StringIO()
+        output.write(f'Profiled for {seconds:g}s, {len(self.commands)} commands finished\n\n')
+
+        slowest = sorted(self.commands, reverse=True)[:20]
+        output.write('Slowest commands (REST time includes waits for rate limits):\n')
+        output.write(render.github_table(
+            [[name, str(channel), f'{seconds * 1000:.1f}', requests, f'{rest * 1000:.1f}',
+              f'{(seconds - rest) * 1000:.1f}'] for (seconds, name, channel, requests, rest) in slowest],
+            ["Command", "Channel", "Total ms", "Requests", "REST ms", "Other ms"]
+        ) if slowest else 'None')
+
+        for sort, title in [('cumulative', 'Top functions by cumulative time'),
+                            ('tottime', 'Top functions by own time')]:
+            output.write(f'\n\n{title}:\n')
+            pstats.Stats(profile, stream=output).sort_stats(sort).print_stats(30)
+
+        return output.getvalue()
+
+
+command_profiler = CommandProfiler(os.getenv('PROFILE_DIR', 'profiles'))
+profile_max_seconds = int(os.getenv('PROFILE_MAX_SECONDS', '300'))
+
+
+@bot.before_invoke
+async def command_started(ctx):
+    ctx.started = time.perf_counter()
+    ctx.started_at = time.time()
+    ctx.requests = []
+    traced_requests.set(ctx.requests)
+
+
+@bot.after_invoke
+async def command_finished(ctx):
+    seconds = time.perf_counter() - ctx.started
+    traced_requests.set(None)
+    bot_metrics.command(ctx.command.qualified_name, seconds, ctx.command_failed)
+    command_profiler.command(ctx, seconds)
+
+    if command_tracer:
+        command_tracer.record(ctx, seconds)
+
+
+class MemberIndex:
+    """
+    Nickname -> member lookup for each guild, built from the gateway's member cache and kept up to date by the member
+    events, so we don't have to page through every member of the guild to find the runners
+    """
+
+    def __init__(self):
+        self.guilds = {}
+
+    def rebuild(self, guild: discord.Guild):
+        self.guilds[guild.id] = {member.nick: member for member in guild.members if member.nick}
+
+    def add(self, member: discord.Member):
+        if member.nick:
+            self.guilds.setdefault(member.guild.id, {})[member.nick] = member
+
+    def remove(self, member: discord.Member):
+        nicks = self.guilds.get(member.guild.id, {})
+
+        if member.nick and member.nick in nicks and nicks[member.nick].id == member.id:
+            del nicks[member.nick]
+
+    def get(self, guild: discord.Guild, nick) -> Optional[discord.Member]:
+        if guild.id not in self.guilds:
+            self.rebuild(guild)
+
+        return self.guilds[guild.id].get(nick)
+
+    async def find(self, guild: discord.Guild, nick) -> Optional[discord.Member]:
+        # discord.py won't query members without a query, and no member's nick is empty anyway
+        if not nick:
+            return None
+
+        member = self.get(guild, nick)
+
+        if member:
+            return member
+
+        # Not in the cache, so ask Discord for just the members matching this nick
+        members = await guild.query_members(query=nick, limit=100)
+        member = discord.utils.get(members, nick=nick)
+
+        if member:
+            self.add(member)
+
+        return member
+
+
+member_index = MemberIndex()
+
+
+class CardIndex:
+    """
+    Lookups over the card list: IDs ignoring case, prefixes of the name or any word in it through a trie, and fuzzy
+    matching of names and IDs by shared trigrams
+    """
+
+    def __init__(self, card_list):
+        self.card_list = card_list
+        self.ids = {card_id.lower(): card_id for card_id in card_list}
+        self.trie = {}
+        self.trigrams = collections.defaultdict(set)
+        self.card_trigrams = {}
+
+        for card_id, card_name in card_list.items():
+            words = card_name.lower().split()
+
+            for i in range(len(words)):
+                self.add_prefixes(' '.join(words[i:]), card_id)
+
+            trigrams = self.trigrams_of(card_name) | self.trigrams_of(card_id)
+            self.card_trigrams[card_id] = trigrams
+
+            for trigram in trigrams:
+                self.trigrams[trigram].add(card_id)
+
+    def add_prefixes(self, text, card_id):
+        node = self.trie
+
+        for char in text:
+            node = node.setdefault(char, {})
+            # '' can't be a character, so it's safe to keep the cards under each node there
+            node.setdefault('', set()).add(card_id)
+
+    @staticmethod
+    def trigrams_of(text):
+        text = f'  {text.lower()} '
+
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def resolve_id(self, query) -> Optional[str]:
+        return self.ids.get(query.lower())
+
+    def by_prefix(self, query):
+        node = self.trie
+
+        for char in query.lower():
+            node = node.get(char)
+
+            if node is None:
+                return set()
+
+        return node.get('', set())
+
+    def fuzzy(self, query, limit=5, threshold=0.3):
+        query_trigrams = self.trigrams_of(query)
+        shared = collections.Counter()
+
+        for trigram in query_trigrams:
+            for card_id in self.trigrams.get(trigram, ()):
+                shared[card_id] += 1
+
+        scores = []
+        for card_id, count in shared.items():
+            score = count / (len(query_trigrams) + len(self.card_trigrams[card_id]) - count)
+
+            if score >= threshold:
+                scores.append((score, card_id))
+
+        scores.sort(key=lambda x: (-x[0], x[1]))
+
+        return [card_id for (_, card_id) in scores[:limit]]
+
+    def search(self, query, limit=10):
+        card_id = self.resolve_id(query)
+
+        if card_id:
+            return [card_id]
+
+        matches = sorted(self.by_prefix(query), key=lambda x: (self.card_list[x], x))[:limit]
+
+        for card_id in self.fuzzy(query, limit):
+            if len(matches) >= limit:
+                break
+
+            if card_id not in matches:
+                matches.append(card_id)
+
+        return matches
+
+    def did_you_mean(self, query):
+        suggestions = ', '.join([f'`{x}` ({self.card_list[x]})' for x in self.search(query, limit=3)])
+
+        return f' - did you mean {suggestions}?' if suggestions else ''
+
+
+card_index = CardIndex(CARD_LIST)
+
+
+class CardImageCache:
+    """
+    In-memory copies of the card images, so playing a card doesn't read a PNG off the disk on the event loop. Holds at
+    most max_bytes of images, dropping the least recently played cards first
+    """
+
+    def __init__(self, directory, max_bytes, preload_prefixes=None, variant=None, min_side=240):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.preload_prefixes = preload_prefixes
+        self.variant = variant
+        self.min_side = min_side
+        self.images = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.preload_seconds = None
+        self.files = self.choose_files()
+
+    def choose_files(self):
+        """
+        Picks which copy of each card to send from the manifest written by build_card_images.py - either the configured
+        variant, or the smallest one whose shortest side is still at least min_side pixels
+        """
+        manifest_path = os.path.join(self.directory, 'variants', 'manifest.json')
+
+        if not os.path.exists(manifest_path):
+            return {}
+
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        files = {}
+
+        for card_id, variants in manifest['cards'].items():
+            if self.variant:
+                chosen = variants.get(self.variant)
+            else:
+                readable = [x for x in variants.values() if min(x['width'], x['height']) >= self.min_side]
+                chosen = min(readable, key=lambda x: x['bytes'], default=None)
+
+            if chosen and os.path.exists(chosen['path']):
+                files[card_id] = chosen['path']
+
+        return files
+
+    def path(self, card_id):
+        return self.files.get(card_id) or os.path.join(self.directory, f'{card_id}.png')
+
+    def filename(self, card_id, card_name):
+        return card_name + os.path.splitext(self.path(card_id))[1]
+
+    def read(self, card_id) -> bytes:
+        with open(self.path(card_id), 'rb') as image:
+            return image.read()
+
+    def read_many(self, card_ids):
+        return {card_id: self.read(card_id) for card_id in card_ids if os.path.exists(self.path(card_id))}
+
+    def put(self, card_id, data: bytes):
+        if card_id in self.images:
+            self.size -= len(self.images.pop(card_id))
+
+        if len(data) > self.max_bytes:
+            return
+
+        self.images[card_id] = data
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            _, dropped = self.images.popitem(last=False)
+            self.size -= len(dropped)
+
+    def drop(self, card_id):
+        if card_id in self.images:
+            self.size -= len(self.images.pop(card_id))
+
+    async def preload(self, card_ids):
+        if self.preload_prefixes:
+            card_ids = [card_id for card_id in card_ids if card_id.startswith(tuple(self.preload_prefixes))]
+
+        start = time.perf_counter()
+        images = await asyncio.get_event_loop().run_in_executor(None, self.read_many, card_ids)
+
+        for card_id, data in images.items():
+            self.put(card_id, data)
+
+        self.preload_seconds = time.perf_counter() - start
+
+        print(
+            f'Preloaded {len(self.images)} card images ({self.size / 1024 / 1024:.1f}MB) '
+            f'in {self.preload_seconds:.2f}s'
+        )
+
+    async def get(self, card_id) -> bytes:
+        data = self.images.get(card_id)
+
+        if data is not None:
+            self.hits += 1
+            self.images.move_to_end(card_id)
+            return data
+
+        self.misses += 1
+
+        return await self.load(card_id)
+
+    async def load(self, card_id) -> bytes:
+        data = await asyncio.get_event_loop().run_in_executor(None, self.read, card_id)
+        self.put(card_id, data)
+
+        return data
+
+    async def warm(self, card_id):
+        if card_id not in self.images:
+            await self.load(card_id)
+
+    async def file(self, card_id, filename) -> discord.File:
+        return discord.File(io.BytesIO(await self.get(card_id)), filename=filename)
+
+
+card_images = CardImageCache(
+    'card-images',
+    int(float(os.getenv('CARD_IMAGE_CACHE_MB', '64')) * 1024 * 1024),
+    [prefix.strip() for prefix in os.getenv('CARD_IMAGE_PRELOAD', '').split(',') if prefix.strip()],
+    os.getenv('CARD_IMAGE_VARIANT'),
+    int(os.getenv('CARD_IMAGE_MIN_SIDE', '240'))
+)
+
+
+class CardAttachmentCache:
+    """
+    Remembers where each card image has already been uploaded to Discord, so playing the card again sends an embed
+    pointing at that upload rather than the whole PNG. URLs older than check_after seconds are checked before they're
+    reused, and forgotten if Discord no longer serves them. Each URL's channel is kept too, so uploads to a run channel
+    can be forgotten as soon as it's cleared
+    """
+
+    def __init__(self, path, asset_channel_id=None, check_after=3600):
+        self.path = path
+        self.asset_channel_id = asset_channel_id
+        self.check_after = check_after
+        self.urls = {}
+        self.uploads = 0
+        self.reuses = 0
+        self.dead = 0
+        self.session: Optional[aiohttp.ClientSession] = None
+
+        if os.path.exists(path):
+            with open(path) as saved:
+                self.urls = json.load(saved)
+
+    def save(self):
+        with open(f'{self.path}.tmp', 'w') as saved:
+            json.dump(self.urls, saved)
+
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def record(self, card_id, message: discord.Message):
+        if not message.attachments:
+            return None
+
+        url = message.attachments[0].url
+        self.urls[card_id] = {
+            'url': url, 'path': card_images.path(card_id), 'channel': message.channel.id, 'checked': time.time()
+        }
+        self.uploads += 1
+        self.save()
+
+        return url
+
+    def forget(self, card_id):
+        if self.urls.pop(card_id, None):
+            self.save()
+
+    def forget_channel(self, channel_id):
+        """Forgets everything uploaded to the channel, when its messages are being deleted"""
+        card_ids = [card_id for (card_id, saved) in self.urls.items() if saved.get('channel') == channel_id]
+
+        for card_id in card_ids:
+            del self.urls[card_id]
+
+        if card_ids:
+            self.save()
+
+    async def is_alive(self, url):
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+
+        try:
+            async with self.session.head(url) as response:
+                return response.status == 200
+        except aiohttp.ClientError:
+            return False
+
+    async def url_for(self, card_id) -> Optional[str]:
+        url = await self.check(card_id)
+
+        if url:
+            self.reuses += 1
+
+        return url
+
+    async def check(self, card_id) -> Optional[str]:
+        saved = self.urls.get(card_id)
+
+        # Uploaded from a different copy of the card than the one we're now configured to send
+        if not saved or saved.get('path') != card_images.path(card_id):
+            return None
+
+        if time.time() - saved['checked'] > self.check_after:
+            if not await self.is_alive(saved['url']):
+                self.dead += 1
+                self.forget(card_id)
+                return None
+
+            saved['checked'] = time.time()
+            self.save()
+
+        return saved['url']
+
+    async def upload(self, card_id, filename) -> Optional[str]:
+        """Uploads the card to the asset channel, if there is one"""
+        channel = bot.get_channel(self.asset_channel_id) if self.asset_channel_id else None
+
+        if not channel:
+            return None
+
+        message = await channel.send(card_id, file=await card_images.file(card_id, filename=filename))
+
+        return self.record(card_id, message)
+
+
+card_attachments = CardAttachmentCache(
+    os.getenv('CARD_URL_CACHE_PATH', 'card-urls.json'),
+    int(os.getenv('CARD_ASSET_CHANNEL_ID')) if os.getenv('CARD_ASSET_CHANNEL_ID') else None,
+    int(os.getenv('CARD_URL_CHECK_AFTER', '3600'))
+)
+
+
+class CardPrefetcher:
+    """
+    When a run has already seen the card after the current one (it was replayed, or stepped back through with
+    previous-card), gets that card ready to send while the current one is being resolved
+    """
+
+    def __init__(self):
+        self.staged = {}
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, channel_id, status: RunStatus):
+        next_depth = status.current_depth + 1
+
+        if next_depth < 0 or next_depth >= len(status.protection_cards):
+            self.staged.pop(channel_id, None)
+            return
+
+        card_id = status.protection_cards[next_depth].card_id
+        self.staged[channel_id] = card_id
+
+        asyncio.ensure_future(self.stage(card_id))
+
+    async def stage(self, card_id):
+        try:
+            await card_images.warm(card_id)
+
+            if not await card_attachments.check(card_id):
+                await card_attachments.upload(card_id, card_images.filename(card_id, CARD_LIST[card_id]))
+        except (OSError, KeyError, discord.DiscordException) as error:
+            print(f'Failed to prefetch {card_id}: {error}')
+
+    def played(self, channel_id, card_id):
+        if self.staged.pop(channel_id, None) == card_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+card_prefetcher = CardPrefetcher()
+
+
+async def reload_cards():
+    """
+    Reads the card list again and swaps it in, along with everything built from it. Only cached images and uploads for
+    cards that have changed are thrown away. Returns the changed cards, and any cards missing an image - in which case
+    nothing is swapped in
+    """
+    global CARD_LIST, card_image_times, card_index
+
+    loop = asyncio.get_event_loop()
+    card_list, image_times = await loop.run_in_executor(None, read_card_catalogue)
+
+    missing = [card_id for card_id in card_list if card_id not in image_times]
+
+    if missing:
+        return [], missing
+
+    index = await loop.run_in_executor(None, CardIndex, card_list)
+    files = await loop.run_in_executor(None, card_images.choose_files)
+
+    changed = [
+        card_id for card_id in set(CARD_LIST) | set(card_list)
+        if CARD_LIST.get(card_id) != card_list.get(card_id)
+        or card_image_times.get(card_id) != image_times.get(card_id)
+        or card_images.files.get(card_id) != files.get(card_id)
+    ]
+
+    CARD_LIST, card_image_times, card_index = card_list, image_times, index
+    card_images.files = files
+
+    for card_id in changed:
+        card_images.drop(card_id)
+        card_attachments.forget(card_id)
+
+    return changed, []
+
+
+def card_catalogue_version():
+    manifest_path = os.path.join(card_images.directory, 'variants', 'manifest.json')
+
+    return [os.path.getmtime(path) if os.path.exists(path) else None for path in ['cards.json', manifest_path]]
+
+
+async def watch_cards(interval):
+    version = card_catalogue_version()
+
+    while True:
+        await asyncio.sleep(interval)
+
+        latest = await asyncio.get_event_loop().run_in_executor(None, card_catalogue_version)
+
+        if latest == version:
+            continue
+
+        version = latest
+
+        try:
+            changed, missing = await reload_cards()
+        except (OSError, ValueError) as error:
+            print(f'Failed to reload cards: {error}')
+            continue
+
+        if missing:
+            print(f'Not reloading cards, no image for: {", ".join(missing)}')
+        else:
+            print(f'Reloaded cards, {len(changed)} changed')
+
+
+card_watcher: Optional[asyncio.Task] = None
+metrics_server: Optional[web.AppRunner] = None
+
+bot_metrics.gauge(
+    'gateway_latency_seconds', 'Time between a gateway heartbeat and its acknowledgement',
+    lambda: None if math.isnan(bot.latency) else bot.latency
+)
+bot_metrics.gauge(
+    'requests_waiting', 'REST requests waiting their turn, per priority class', lambda: request_scheduler.waiting,
+    'priority'
+)
+bot_metrics.gauge('runs_cached', 'Runs in the run status cache', lambda: len(run_cache.runs))
+bot_metrics.gauge(
+    'commands_queued', 'Commands running or queued in run channels', lambda: sum(run_actors.depths().values())
+)
+
+
+@bot.event
+async def on_ready():
+    for guild in bot.guilds:
+        member_index.rebuild(guild)
+
+    print(f'{bot.user.name} has connected to Discord!')
+
+    global card_watcher
+
+    if card_watcher is None and float(os.getenv('CARD_WATCH_INTERVAL', '0')) > 0:
+        card_watcher = asyncio.ensure_future(watch_cards(float(os.getenv('CARD_WATCH_INTERVAL'))))
+
+    global metrics_server
+
+    if metrics_server is None and os.getenv('METRICS_PORT'):
+        metrics_server = await metrics.serve(
+            bot_metrics, os.getenv('METRICS_HOST', '127.0.0.1'), int(os.getenv('METRICS_PORT'))
+        )
+
+    if card_images.preload_seconds is None:
+        await card_images.preload(list(CARD_LIST))
+
+
+@bot.event
+async def on_guild_join(guild):
+    member_index.rebuild(guild)
+
+
+@bot.event
+async def on_member_join(member):
+    member_index.add(member)
+
+
+@bot.event
+async def on_member_update(before, after):
+    member_index.remove(before)
+    member_index.add(after)
+
+
+@bot.event
+async def on_member_remove(member):
+    member_index.remove(member)
+
+
+control_role_name = 'Control' if os.getenv('UPPERCASE_CONTROL') else 'control'
+
+
+@bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    cached = run_cache.runs.get(payload.channel_id)
+
+    if not cached or cached.message.id != payload.message_id:
+        return
+
+    # Our own edits come back through here too - only throw the status away if someone else changed it
+    content = payload.data.get('content', cached.content)
 
-        return self.active_group_obj
+    if content != cached.content and not status_editor.sent_by_us(payload.channel_id, content):
+        run_cache.invalidate(payload.channel_id)
 
-    def add_card(self, card_id):
-        card_name = CARD_LIST[card_id]
-        self.protection_cards.append(ProtectionCard(card_id=card_id, card_name=card_name, boost=0))
 
-    def get_active_card(self):
-        if self.current_depth < 0 or self.current_depth >= len(self.protection_cards):
-            raise ValueError(f'Unknown active card - do you need to run {command_prefix}next-card?')
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    run_cache.invalidate_message(payload.channel_id, payload.message_id)
 
-        return self.protection_cards[self.current_depth]
+
+@bot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    for message_id in payload.message_ids:
+        run_cache.invalidate_message(payload.channel_id, message_id)
 
 
 @bot.event
-async def on_ready():
-    print(f'{bot.user.name} has connected to Discord!')
+async def on_guild_channel_pins_update(channel, last_pin):
+    run_cache.invalidate(channel.id)
 
 
-control_role_name = 'Control' if os.getenv('UPPERCASE_CONTROL') else 'control'
+@bot.event
+async def on_guild_channel_delete(channel):
+    run_cache.invalidate(channel.id)
+    card_attachments.forget_channel(channel.id)
+    run_actors.remove(channel.id)
+    status_editor.forget(channel.id)
 
 
 @bot.event
@@ -365,12 +1957,18 @@ async def initiate_run(author, text_channel, role_to_mention, channel_role, send
 
         status = RunStatus()
 
-        status.add_to_group(1, author.nick)
+        status.add_to_group(1, author.nick or author.name)
 
-        message = await text_channel.send(str(status))
+        content, footer = status.pages()[0]
+        message = await text_channel.send(content, embed=page_embed(footer))
 
         await message.pin()
 
+        run_cache.store(text_channel.id, message, status)
+
+        if run_store:
+            run_store.save(text_channel.guild.id, text_channel.id, message.id, status)
+
         await text_channel.send(
             "!!! RUN INITIATED !!!\n" +
             f"{role_to_mention.mention} please send your security representative to defend\n" +
@@ -385,13 +1983,14 @@ async def initiate_run(author, text_channel, role_to_mention, channel_role, send
             f" - see your relevant Google doc for the command you need"
         )
     else:
-        message = await pinned_message_from_channel(text_channel)
+        async def join_run():
+            message, status = await run_status_from_channel(text_channel)
 
-        status = RunStatus.from_message(message)
+            status.add_to_group(1, author.nick or author.name)
 
-        status.add_to_group(1, author.nick)
+            await save_run_status(text_channel, message, status)
 
-        await message.edit(content=status)
+        await run_actors.get(text_channel.id).submit(join_run)
 
     await author.add_roles(channel_role)
     await text_channel.send(
@@ -461,9 +2060,10 @@ async def plot_run(ctx, description: str):
 
 
 @bot.command(name='defend', help='Switch to defending a run instead of attacking')
+@one_at_a_time_per_run
 async def defend(ctx: commands.context.Context):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -473,22 +2073,21 @@ async def defend(ctx: commands.context.Context):
         )
         return
 
-    status = RunStatus.from_message(message)
-
-    nickname = ctx.author.nick
+    nickname = ctx.author.nick or ctx.author.name
 
     status.defenders.append(nickname)
     status.remove_from_group(nickname)
 
-    await message.edit(content=status)
+    await save_run_status(ctx.channel, message, status)
 
     await ctx.send('Moved {} to defender'.format(ctx.author.mention))
 
 
 @bot.command(name='group', help='Switch to a different runner group')
+@one_at_a_time_per_run
 async def join_group(ctx: commands.context.Context, group_num: int):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -498,34 +2097,106 @@ async def join_group(ctx: commands.context.Context, group_num: int):
         )
         return
 
-    status = RunStatus.from_message(message)
-
-    nickname = ctx.author.nick
+    nickname = ctx.author.nick or ctx.author.name
 
     status.remove_from_group(nickname)
     status.add_to_group(group_num, nickname)
 
-    await message.edit(content=status)
+    await save_run_status(ctx.channel, message, status)
 
     await ctx.send('Moved {} to group {}'.format(ctx.author.mention, group_num))
 
 
-async def pinned_message_from_context(ctx):
-    return await pinned_message_from_channel(ctx.channel)
+async def run_status_from_context(ctx):
+    return await run_status_from_channel(ctx.channel)
+
+
+async def run_status_from_channel(channel: discord.TextChannel):
+    cached = run_cache.get(channel.id)
+
+    if cached:
+        return cached.message, copy.deepcopy(cached.status)
+
+    # Commands that only read the status aren't queued behind the ones changing it, so one of those could save a newer
+    # status while this reads the pins - in which case that's the one to keep
+    generation = run_cache.generation(channel.id)
+
+    # A change still waiting to be written is newer than the pins or the store, so write it out before reading them
+    try:
+        await status_editor.flush(channel.id)
+    except discord.DiscordException as error:
+        print(f'Failed to update the run status in channel {channel.id}: {error}')
+
+    stored = run_store.load(channel.guild.id, channel.id) if run_store else None
+
+    if stored:
+        message_id, status = stored
+        message = channel.get_partial_message(message_id)
+        extra_pages = [channel.get_partial_message(x) for x in run_store.load_pages(channel.guild.id, channel.id)]
+    else:
+        messages = await status_messages_from_channel(channel)
+        message, extra_pages = messages[0], messages[1:]
+
+        with bot_metrics.phase('parse'):
+            status = RunStatus.from_messages(messages)
+
+        if run_cache.generation(channel.id) != generation:
+            newer = run_cache.runs.get(channel.id)
 
+            return (newer.message, copy.deepcopy(newer.status)) if newer else (message, status)
+
+        if run_store:
+            run_store.save(channel.guild.id, channel.id, message.id, status)
+            run_store.set_pages(channel.guild.id, channel.id, [x.id for x in extra_pages])
+
+    status_editor.found_pages(channel.id, extra_pages)
+    run_cache.store(channel.id, message, status)
+
+    return message, status
+
+
+async def save_run_status(channel: discord.TextChannel, message: discord.Message, status: RunStatus):
+    cached = run_cache.store(channel.id, message, status)
+
+    if run_store:
+        run_store.save(channel.guild.id, channel.id, message.id, status)
+
+    await status_editor.schedule(channel, message, cached.pages)
+
+
+def status_pages_from_pins(pins):
+    """The pinned pages of the run status in order, stopping at any gap"""
+    numbered = {}
+
+    for message in pins:
+        number = status_page_number(message.content)
+
+        if number and number not in numbered:
+            numbered[number] = message
+
+    pages = []
+
+    while len(pages) + 1 in numbered:
+        pages.append(numbered[len(pages) + 1])
+
+    return pages
+
+
+async def status_messages_from_channel(channel: discord.TextChannel):
+    with bot_metrics.phase('pins'):
+        pins = await channel.pins()
 
-async def pinned_message_from_channel(channel: discord.TextChannel):
-    pins = await channel.pins()
     if not pins:
         raise ValueError('No pinned message found, did you run this in a run channel?')
-    message: discord.Message = pins[0]
-    return message
+
+    # Fall back to the latest pin if none of them look like a status
+    return status_pages_from_pins(pins) or [pins[0]]
 
 
 @bot.command(name='run-status', help='Redisplay the run status')
 async def run_status(ctx: commands.context.Context):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -535,13 +2206,143 @@ async def run_status(ctx: commands.context.Context):
         )
         return
 
-    await ctx.send(content=str(RunStatus.from_message(message)))
+    # A long run doesn't fit in one message, so send it a page at a time like the pinned status
+    for content, _ in status.pages():
+        await ctx.send(content=content)
+
+
+@bot.command(name='run-stats', help='Shows run status cache, batched edit and per-run queue statistics')
+@commands.has_role(control_role_name)
+async def run_stats(ctx: commands.context.Context):
+    lookups = run_cache.hits + run_cache.misses
+    hit_rate = run_cache.hits / lookups * 100 if lookups else 0
+
+    await ctx.send(
+        f'Run status cache: {len(run_cache.runs)} runs cached\n'
+        f'Hits: {run_cache.hits}, misses: {run_cache.misses} ({hit_rate:.1f}% hit rate)\n'
+        f'Status edits: {status_editor.requested} requested, {status_editor.issued} issued, '
+        f'{status_editor.saved} saved by batching\n'
+        f'Status pages: {status_editor.pages_edited} edited, {status_editor.pages_unchanged} left alone as unchanged'
+    )
+
+    queued = {channel_id: depth for (channel_id, depth) in run_actors.depths().items() if depth}
+
+    if queued:
+        queue_lines = [f'<#{channel_id}>: {depth}' for (channel_id, depth) in queued.items()]
+        await ctx.send('Commands queued per run:\n' + '\n'.join(queue_lines))
+
+
+def milliseconds(histogram: metrics.Histogram, q):
+    return round(histogram.quantile(q) * 1000)
+
+
+@bot.command(name='bot-stats', help='Shows command latency, Discord request and rate limit statistics')
+@commands.has_role(control_role_name)
+async def bot_stats(ctx: commands.context.Context):
+    uptime = datetime.timedelta(seconds=round(time.time() - bot_metrics.started))
+    latency = 'unknown' if math.isnan(bot.latency) else f'{bot.latency * 1000:.0f}ms'
+    command_rows = [
+        [name, histogram.count, bot_metrics.command_errors[name], milliseconds(histogram, 0.5),
+         milliseconds(histogram, 0.9)]
+        for name, histogram in sorted(bot_metrics.commands.items(), key=lambda x: -x[1].count)[:10]
+    ]
+    phase_rows = [
+        [name, histogram.count, milliseconds(histogram, 0.5), milliseconds(histogram, 0.9)]
+        for name, histogram in sorted(bot_metrics.phases.items())
+    ]
+
+    commands_table = render.github_table(command_rows, ["Command", "Count", "Errors", "p50 ms", "p90 ms"])
+    phases_table = render.github_table(phase_rows, ["Phase", "Count", "p50 ms", "p90 ms"])
+
+    await ctx.send(
+        f'Up {uptime}, gateway latency {latency}\n'
+        + (f'Busiest commands:\n```\n{commands_table}\n```\n' if command_rows else 'No commands run yet\n')
+        + (f'Command phases:\n```\n{phases_table}\n```' if phase_rows else '')
+    )
+
+    requests = sum(x.count for x in bot_metrics.requests.values())
+    errors = sum(bot_metrics.request_errors.values())
+    route_rows = [
+        [route, histogram.count, milliseconds(histogram, 0.5), milliseconds(histogram, 0.9)]
+        for route, histogram in sorted(bot_metrics.requests.items(), key=lambda x: -x[1].count)[:10]
+    ]
+    routes_table = render.github_table(route_rows, ["Route", "Requests", "p50 ms", "p90 ms"])
+    rate_limits = ', '.join([
+        f'{route}: {count} ({bot_metrics.rate_limit_seconds[route]:.1f}s)'
+        for route, count in bot_metrics.rate_limits.most_common(5)
+    ])
+
+    queues = ', '.join([
+        f'{priority} {bot_metrics.queue_waits[priority].count} sent, {request_scheduler.waiting[priority]} waiting, '
+        f'p90 wait {milliseconds(bot_metrics.queue_waits[priority], 0.9)}ms'
+        for priority in request_priorities if bot_metrics.queue_waits[priority].count
+    ])
+
+    await ctx.send(
+        f'Discord requests: {requests}, {errors} failed\n'
+        + (f'Request queues: {queues}\n' if queues else '')
+        + (f'```\n{routes_table}\n```\n' if route_rows else '')
+        + f'Rate limited (429) {sum(bot_metrics.rate_limits.values())} times, waiting '
+        + f'{sum(bot_metrics.rate_limit_seconds.values()):.1f}s'
+        + (f' - {rate_limits}' if rate_limits else '')
+    )
+
+
+@bot.command(name='profile', help='Profiles the bot for the given number of seconds and posts what took the time')
+@commands.has_role(control_role_name)
+async def profile_bot(ctx: commands.context.Context, seconds: float):
+    if not 0 < seconds <= profile_max_seconds:
+        await ctx.send(f'{ctx.author.mention} - profile for between 0 and {profile_max_seconds} seconds')
+        return
+
+    if command_profiler.active:
+        await ctx.send(f'{ctx.author.mention} - already profiling, try again once that\'s finished')
+        return
+
+    await ctx.send(f'Profiling for {seconds:g}s...')
+
+    report, path = await command_profiler.run(seconds)
+
+    await ctx.send(
+        f'{ctx.author.mention} - profile finished, raw profile saved to `{path}`',
+        file=discord.File(io.BytesIO(report.encode()), filename='profile.txt')
+    )
+
+
+@bot.command(name='import-runs', help='Copies the pinned status of every active run into the run store')
+@commands.has_role(control_role_name)
+@background_priority
+async def import_runs(ctx: commands.context.Context):
+    if not run_store:
+        await ctx.send('No run store configured - set RUN_STORE_PATH and restart the bot first')
+        return
+
+    imported = 0
+
+    for category in ctx.guild.categories:
+        if category.name.find('runs-') != 0:
+            continue
+
+        for channel in category.text_channels:
+            pages = status_pages_from_pins(await channel.pins())
+
+            if not pages:
+                continue
+
+            status = RunStatus.from_messages(pages)
+            run_store.save(ctx.guild.id, channel.id, pages[0].id, status)
+            run_store.set_pages(ctx.guild.id, channel.id, [x.id for x in pages[1:]])
+            run_cache.invalidate(channel.id)
+            imported += 1
+
+    await ctx.send(f'Imported {imported} runs into the run store')
 
 
 @bot.command(name='start-run', help='Defend a facility against a group of runners (defaults to group 1)')
+@one_at_a_time_per_run
 async def start_run(ctx: commands.context.Context, group_num=1):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -551,7 +2352,6 @@ async def start_run(ctx: commands.context.Context, group_num=1):
         )
         return
 
-    status = RunStatus.from_message(message)
     status.current_depth = -1
 
     await ctx.send(f'Beginning defence against group {group_num}...')
@@ -564,10 +2364,8 @@ async def start_run(ctx: commands.context.Context, group_num=1):
 
     active_group = status.get_active_group()
 
-    channel_members = await ctx.guild.fetch_members().flatten()
-
     for runner in active_group.runners:
-        member: discord.Member = discord.utils.get(channel_members, nick=runner)
+        member: discord.Member = await member_index.find(ctx.guild, runner)
 
         if member:
             await ctx.send(
@@ -584,13 +2382,14 @@ async def start_run(ctx: commands.context.Context, group_num=1):
         )
     )
 
-    await message.edit(content=status)
+    await save_run_status(ctx.channel, message, status)
 
 
 @bot.command(name='alerts', help='Adds alerts to the active run')
+@one_at_a_time_per_run
 async def add_alerts(ctx: commands.context.Context, num_alerts: int):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -600,7 +2399,6 @@ async def add_alerts(ctx: commands.context.Context, num_alerts: int):
         )
         return
 
-    status = RunStatus.from_message(message)
     status.alerts += num_alerts
 
     await ctx.send(
@@ -610,13 +2408,14 @@ async def add_alerts(ctx: commands.context.Context, num_alerts: int):
         )
     )
 
-    await message.edit(content=status)
+    await save_run_status(ctx.channel, message, status)
 
 
 @bot.command(name='next-card', help='Plays the next card in the facility')
+@one_at_a_time_per_run
 async def next_card(ctx: commands.context.Context, card=None):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -626,7 +2425,6 @@ async def next_card(ctx: commands.context.Context, card=None):
         )
         return
 
-    status = RunStatus.from_message(message)
     status.current_depth += 1
 
     if card is None:
@@ -643,6 +2441,7 @@ async def next_card(ctx: commands.context.Context, card=None):
         card = status.protection_cards[status.current_depth].card_id
         await play_card(ctx, card)
     else:
+        card = card_index.resolve_id(card) or card
         add = False
         if status.current_depth < len(status.protection_cards):
             next_card = status.protection_cards[status.current_depth].card_id
@@ -662,7 +2461,9 @@ async def next_card(ctx: commands.context.Context, card=None):
         if add:
             status.add_card(card)
 
-    await message.edit(content=status)
+    card_prefetcher.played(ctx.channel.id, card)
+
+    await save_run_status(ctx.channel, message, status)
 
     await ctx.send(
         f'Facing card {status.current_depth + 1}\n'
@@ -672,11 +2473,14 @@ async def next_card(ctx: commands.context.Context, card=None):
         f'Once this card has been resolved, use `{command_prefix}next-card <card-id>` to move to the next card'
     )
 
+    card_prefetcher.prefetch(ctx.channel.id, status)
+
 
 @bot.command(name='previous-card', help='Goes back one card in the facility')
+@one_at_a_time_per_run
 async def previous_card(ctx: commands.context.Context):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -686,7 +2490,6 @@ async def previous_card(ctx: commands.context.Context):
         )
         return
 
-    status = RunStatus.from_message(message)
     status.current_depth -= 1
 
     # Get the next card from the status
@@ -702,7 +2505,7 @@ async def previous_card(ctx: commands.context.Context):
     card = status.protection_cards[status.current_depth].card_id
     await play_card(ctx, card)
 
-    await message.edit(content=status)
+    await save_run_status(ctx.channel, message, status)
 
     await ctx.send(
         f'Facing card {status.current_depth + 1}\n'
@@ -712,11 +2515,14 @@ async def previous_card(ctx: commands.context.Context):
         f'Once this card has been resolved, use `{command_prefix}next-card <card-id>` to move to the next card'
     )
 
+    card_prefetcher.prefetch(ctx.channel.id, status)
+
 
 @bot.command(name='boost', help='Boost the currently active card')
+@one_at_a_time_per_run
 async def boost(ctx: commands.context.Context, amount: int):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -726,8 +2532,6 @@ async def boost(ctx: commands.context.Context, amount: int):
         )
         return
 
-    status = RunStatus.from_message(message)
-
     active_card: ProtectionCard
 
     try:
@@ -743,9 +2547,9 @@ async def boost(ctx: commands.context.Context, amount: int):
 
     active_card.boost += amount
 
-    await message.edit(content=status)
+    await save_run_status(ctx.channel, message, status)
 
-    amount_to_pay = sum(range(active_card.boost - amount + 1, active_card.boost + 1))
+    amount_to_pay = rules.boost_cost(active_card.boost - amount, active_card.boost)
 
     await ctx.send(
         f'Boosted `{active_card.card_name}` by {amount} (new amount is {active_card.boost})\n'
@@ -756,7 +2560,7 @@ async def boost(ctx: commands.context.Context, amount: int):
 @bot.command(name='calculate-strength', help='Calculate the strength of the currently active card')
 async def boost(ctx: commands.context.Context):
     try:
-        message = await pinned_message_from_context(ctx)
+        message, status = await run_status_from_context(ctx)
     except ValueError as error:
         await ctx.send(
             '{} - {}'.format(
@@ -766,8 +2570,6 @@ async def boost(ctx: commands.context.Context):
         )
         return
 
-    status = RunStatus.from_message(message)
-
     active_card: ProtectionCard
 
     try:
@@ -783,9 +2585,9 @@ async def boost(ctx: commands.context.Context):
 
     bonus_from_alerts = status.bonus_from_alerts(status.alerts)
     bonus_from_boost = active_card.boost
-    bonus_from_depth = math.floor(status.current_depth / 2)
+    bonus_from_depth = status.bonus_from_depth(status.current_depth)
 
-    table = tabulate.tabulate(
+    table = render.github_table(
         [
             ['Alerts', status.alerts, bonus_from_alerts],
             ['Boost', active_card.boost, bonus_from_boost],
@@ -793,8 +2595,7 @@ async def boost(ctx: commands.context.Context):
         ],
         [
             'Section', 'Amount', 'Bonus'
-        ],
-        tablefmt="github"
+        ]
     )
 
     total_bonus = bonus_from_boost + bonus_from_alerts + bonus_from_depth
@@ -803,75 +2604,433 @@ async def boost(ctx: commands.context.Context):
     )
 
 
+@bot.command(
+    name='optimise-boost',
+    help='Works out how to spread a boost budget over the cards left in the run: <budget> [attack dice] [card dice]'
+)
+async def optimise_boost(ctx: commands.context.Context, budget: int, attack_dice: int = 6, card_dice: int = 3):
+    if not 0 <= budget <= optimise_max_budget:
+        await ctx.send(f'{ctx.author.mention} - the budget must be between 0 and {optimise_max_budget}')
+        return
+
+    if not (1 <= attack_dice <= optimise_max_dice and 0 <= card_dice <= optimise_max_dice):
+        await ctx.send(
+            f'{ctx.author.mention} - use between 1 and {optimise_max_dice} attack dice, '
+            f'and up to {optimise_max_dice} card dice'
+        )
+        return
+
+    try:
+        message, status = await run_status_from_context(ctx)
+    except ValueError as error:
+        await ctx.send(
+            '{} - {}'.format(
+                ctx.author.mention,
+                error.args[0]
+            )
+        )
+        return
+
+    first_depth = max(status.current_depth, 0)
+    cards = status.protection_cards[first_depth:]
+
+    if not cards:
+        await ctx.send(f'{ctx.author.mention} - there are no cards left to boost')
+        return
+
+    # Off the event loop, as simulate does, so everyone else's commands carry on while it works
+    plan = await asyncio.get_event_loop().run_in_executor(None, functools.partial(
+        optimise.optimise_boost, [card.boost for card in cards], status.alerts, first_depth, budget, attack_dice,
+        card_dice, threshold=dice_success_threshold
+    ))
+
+    table = render.github_table(
+        [
+            [card.card_name, card.boost, extra, cost, f'{(1 - chance) * 100:.1f}%']
+            for card, extra, cost, chance in zip(cards, plan.extra_boosts, plan.costs, plan.pass_chances)
+        ],
+        [
+            'Card name', 'Boost', 'Add', 'Cost', 'Stops runners'
+        ]
+    )
+
+    await ctx.send(
+        f'```\n{table}\n```'
+        f'Total cost: {plan.total_cost} of {budget}\n'
+        f'Chance of stopping {attack_dice}d8 runners: {plan.boosted_stop_chance * 100:.1f}% '
+        f'(without boosting: {plan.unboosted_stop_chance * 100:.1f}%)'
+    )
+
+
+@bot.command(
+    name='odds',
+    help='Works out the chances of a roll, e.g. `7d8 vs 3d8`. In a run, the active card\'s bonus dice are added to the '
+         'defender, so `7d8` on its own is against just the bonus dice'
+)
+async def odds(ctx: commands.context.Context, *die_strings: str):
+    words = [x.lower() for x in die_strings]
+    split = words.index('vs') if 'vs' in words else len(words)
+
+    try:
+        attacker_pools, attacker_modifier = dice.parse_dice(die_strings[:split], dice_max_sides)
+        defender_pools, defender_modifier = (
+            dice.parse_dice(die_strings[split + 1:], dice_max_sides) if split < len(words) else ([], 0)
+        )
+    except ValueError as error:
+        await ctx.send(f'{ctx.author.mention} {error.args[0]} - try something like `{command_prefix}odds 7d8 vs 3d8`')
+        return
+
+    bonus = 0
+    category = getattr(ctx.channel, 'category', None)
+
+    if category and category.name.find('runs-') == 0:
+        try:
+            message, status = await run_status_from_context(ctx)
+            bonus = status.total_bonus_dice()
+        except ValueError:
+            pass
+
+    if bonus > 0:
+        sides = defender_pools[0].sides if defender_pools else attacker_pools[0].sides
+        defender_pools.append(dice.DicePool(bonus, sides))
+
+    if not defender_pools:
+        await ctx.send(f'{ctx.author.mention} nothing to roll against - try `{command_prefix}odds 7d8 vs 3d8`')
+        return
+
+    if sum(pool.amount for pool in attacker_pools + defender_pools) > odds_max_dice:
+        await ctx.send(f'{ctx.author.mention} too many dice - odds work for up to {odds_max_dice} dice in total')
+        return
+
+    attacker = dice.distribution_for(attacker_pools, dice_success_threshold)
+    defender = dice.distribution_for(defender_pools, dice_success_threshold)
+    win, tie, lose = dice.compare_distributions(attacker, defender, attacker_modifier - defender_modifier)
+
+    def describe(pools, modifier):
+        return ' '.join([str(x) for x in pools] + ([f'{modifier:+d}'] if modifier else []))
+
+    bonus_text = f' (including {bonus} bonus dice from the active card)' if bonus else ''
+
+    await ctx.send(
+        f'{describe(attacker_pools, attacker_modifier)} vs {describe(defender_pools, defender_modifier)}{bonus_text}\n'
+        f'Attacker gets more successes: {win * 100:.1f}%\n'
+        f'Same number of successes: {tie * 100:.1f}%\n'
+        f'Defender gets more successes: {lose * 100:.1f}%\n'
+        f'Average successes: attacker {dice.expected_successes(attacker) + attacker_modifier:.1f}, '
+        f'defender {dice.expected_successes(defender) + defender_modifier:.1f}'
+    )
+
+
+@bot.command(
+    name='simulate',
+    help='Simulates lots of runs against a facility: <runners> <cards> [boost budget] [attack dice] [card dice] [runs]'
+)
+async def simulate_runs(ctx: commands.context.Context, runners: int, cards: int, boost_budget: int = 0,
+                        attack_dice: int = 6, card_dice: int = 3, trials: int = 100000):
+    if not (1 <= trials <= simulate_max_trials and 0 <= runners <= simulate_max_runners
+            and 1 <= cards <= simulate_max_cards and 0 <= boost_budget <= simulate_max_budget
+            and 1 <= attack_dice <= simulate_max_dice and 0 <= card_dice <= simulate_max_dice):
+        await ctx.send(
+            f'{ctx.author.mention} - usage: `{command_prefix}simulate <runners> <cards> [boost budget] [attack dice] '
+            f'[card dice] [runs]`, with up to {simulate_max_runners} runners, 1 to {simulate_max_cards} cards, a '
+            f'budget of up to {simulate_max_budget}, 1 to {simulate_max_dice} attack dice, up to {simulate_max_dice} '
+            f'card dice and 1 to {simulate_max_trials} runs'
+        )
+        return
+
+    settings = simulate.SimulationSettings(
+        runners, cards, attack_dice, card_dice, boost_budget, sides=8, threshold=dice_success_threshold
+    )
+
+    # Off the event loop, so everyone else's commands carry on while it runs
+    result = await asyncio.get_event_loop().run_in_executor(
+        None, simulate.simulate, settings, trials, simulate_workers
+    )
+
+    await ctx.send(f'```\n{result.summary()}\n```')
+
+
+class PurgeProgress:
+    """The one clear-runs progress message, edited every PURGE_PROGRESS_INTERVAL seconds while anything's changed"""
+
+    def __init__(self, message: discord.Message, interval: float):
+        self.message = message
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.channels = 0
+        self.channels_done = 0
+        self.channels_recreated = 0
+        self.messages_deleted = 0
+        self.roles = 0
+        self.roles_deleted = 0
+        self.failed = []
+        self.changed = False
+        self.sent = ''
+        self.editor: Optional[asyncio.Task] = None
+
+    def text(self, finished=False, cleared=True):
+        if not finished:
+            heading = 'Clearing runs, please wait...'
+        else:
+            heading = 'Runs cleared' if cleared else 'Stopped clearing runs after an error'
+
+        lines = [
+            f'{heading} ({time.perf_counter() - self.started:.1f}s)',
+            f'Channels: {self.channels_done} of {self.channels} cleared, {self.channels_recreated} recreated, '
+            f'{self.messages_deleted} messages deleted',
+            f'Run roles: {self.roles_deleted} of {self.roles} deleted',
+        ]
+
+        if self.failed:
+            lines.append(f'Failed: {", ".join(self.failed)}')
+
+        return '\n'.join(lines)
+
+    def update(self):
+        self.changed = True
+
+        if not self.editor:
+            self.editor = asyncio.ensure_future(self.keep_editing())
+
+    async def keep_editing(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            if self.changed:
+                self.changed = False
+                await self.edit(self.text())
+
+    async def edit(self, content):
+        if content == self.sent:
+            return
+
+        try:
+            await self.message.edit(content=content)
+            self.sent = content
+        except discord.DiscordException as error:
+            print(f'Failed to update the clear-runs progress: {error}')
+
+    async def finish(self, cleared=True):
+        if self.editor:
+            self.editor.cancel()
+
+        await self.edit(self.text(finished=True, cleared=cleared))
+
+
+class ChannelPurger:
+    """
+    Empties run channels for clear-runs, several at once. Each channel's history is read, up to one message past
+    PURGE_CLONE_THRESHOLD, before anything's deleted. If there's more than that, or more than PURGE_SINGLE_DELETE_LIMIT
+    messages too old to bulk delete, the channel is cloned and the original deleted. Otherwise the messages are deleted
+    (in bulk when under 14 days old, one by one when older) and the history read again, until there's nothing left
+    """
+
+    # Discord won't bulk delete messages older than this, so leave some margin
+    bulk_delete_age = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+    bulk_delete_limit = 100
+
+    def __init__(self, concurrency: int, clone_threshold: int, single_delete_limit: int):
+        self.concurrency = concurrency
+        self.clone_threshold = clone_threshold
+        self.single_delete_limit = single_delete_limit
+
+    async def purge_all(self, channels, progress: PurgeProgress):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def purge_one(channel):
+            async with semaphore:
+                try:
+                    await self.purge(channel, progress)
+                except discord.DiscordException as error:
+                    print(f'Failed to clear {channel.name}: {error}')
+                    progress.failed.append(channel.name)
+
+                progress.channels_done += 1
+                progress.update()
+
+        await asyncio.gather(*[purge_one(channel) for channel in channels])
+
+    async def purge(self, channel: discord.TextChannel, progress: PurgeProgress):
+        while True:
+            # Only messages that are still there count towards cloning instead
+            messages = await channel.history(limit=self.clone_threshold + 1).flatten()
+
+            if not messages:
+                break
+
+            cutoff = datetime.datetime.utcnow() - self.bulk_delete_age
+            recent = [message for message in messages if message.created_at > cutoff]
+            old = [message for message in messages if message.created_at <= cutoff]
+
+            if len(messages) > self.clone_threshold or len(old) > self.single_delete_limit:
+                await self.recreate(channel)
+                progress.channels_recreated += 1
+                break
+
+            for i in range(0, len(recent), self.bulk_delete_limit):
+                await channel.delete_messages(recent[i:i + self.bulk_delete_limit])
+
+            for message in old:
+                try:
+                    await message.delete()
+                except discord.NotFound:
+                    pass
+
+            progress.messages_deleted += len(messages)
+            progress.update()
+
+        run_cache.invalidate(channel.id)
+        status_editor.forget(channel.id)
+        # Cards played here were uploaded with the play messages, so those uploads are gone now too
+        card_attachments.forget_channel(channel.id)
+
+    @staticmethod
+    async def recreate(channel: discord.TextChannel):
+        """Swaps the channel for an empty copy, with the same name, category, permissions and place"""
+        position = channel.position
+        clone = await channel.clone(reason='Clearing runs')
+        await channel.delete(reason='Clearing runs')
+        await clone.edit(position=position)
+
+        return clone
+
+
+channel_purger = ChannelPurger(
+    int(os.getenv('PURGE_CONCURRENCY', '5')),
+    int(os.getenv('PURGE_CLONE_THRESHOLD', '500')),
+    int(os.getenv('PURGE_SINGLE_DELETE_LIMIT', '20'))
+)
+purge_progress_interval = float(os.getenv('PURGE_PROGRESS_INTERVAL', '2.0'))
+
+
 @bot.command(name='clear-runs', help='Deletes *all* run channels and roles for end of turn clean up')
 @commands.has_role(control_role_name)
+@background_priority
 async def clear_runs(ctx):
     guild = ctx.guild
+    progress = PurgeProgress(await ctx.send('Clearing runs, please wait...'), purge_progress_interval)
+    semaphore = asyncio.Semaphore(channel_purger.concurrency)
 
-    # Get all channels in this category
-    for corp_name in CORPORATION_NAMES:
-        category_name = f'runs-{corp_name}'
-        category = discord.utils.get(guild.categories, name=category_name)
+    async def delete(thing):
+        async with semaphore:
+            try:
+                await thing.delete()
+            except discord.NotFound:
+                pass
+            except discord.DiscordException as error:
+                print(f'Failed to delete {thing.name}: {error}')
+                progress.failed.append(thing.name)
+                progress.update()
+                return
 
-        if category:
-            channels = category.text_channels
-            await ctx.send(f'Deleting content in {len(channels)} channels, please wait...')
+        if isinstance(thing, discord.Role):
+            progress.roles_deleted += 1
 
-            channel: discord.TextChannel
-            delta = datetime.timedelta(days=14)
-            for channel in channels:
-                msgs = await channel.history(limit=100, after=datetime.datetime.now() - delta).flatten()
-                if not msgs:
-                    continue
+        progress.update()
 
-                try:
-                    await ctx.send(f'Deleting content in {channel.name}')
-                    await channel.delete_messages(msgs)
-                except discord.DiscordException:
-                    continue
+    # Stops the progress editor however the purge ends, saying whether it got to the end
+    cleared = False
 
-    plot_category: Optional[discord.CategoryChannel] = discord.utils.get(guild.categories, name='runs-plot')
+    try:
+        # Empty every run channel in the corporation categories
+        channels = []
 
-    if plot_category:
-        await ctx.send('Clearing plot channels')
-        channels = plot_category.text_channels
+        for corp_name in CORPORATION_NAMES:
+            category = discord.utils.get(guild.categories, name=f'runs-{corp_name}')
 
-        channel: discord.TextChannel
-        for channel in channels:
-            try:
-                await channel.delete()
-            except discord.DiscordException:
-                continue
+            if category:
+                channels += category.text_channels
 
-        channel: discord.VoiceChannel
-        channels = plot_category.voice_channels
-        for channel in channels:
-            try:
-                await channel.delete()
-            except discord.DiscordException:
-                continue
+        progress.channels = len(channels)
+        await channel_purger.purge_all(channels, progress)
 
-    role: discord.Role
-    for role in guild.roles:
-        if role.name.find('run-') == 0:
-            await role.delete()
+        # Plot channels go altogether
+        plot_category: Optional[discord.CategoryChannel] = discord.utils.get(guild.categories, name='runs-plot')
+
+        if plot_category:
+            plot_channels = plot_category.text_channels + plot_category.voice_channels
+            await asyncio.gather(*[delete(channel) for channel in plot_channels])
+
+        roles = [role for role in guild.roles if role.name.find('run-') == 0]
+        progress.roles = len(roles)
+        await asyncio.gather(*[delete(role) for role in roles])
+
+        if run_store:
+            run_store.delete_guild(guild.id)
+
+        cleared = True
+    finally:
+        await progress.finish(cleared)
 
-    await ctx.send(f'Runs cleared')
     await guild.fetch_roles()
 
 
 @bot.command(name='play', help='Plays the card with the given name')
 async def play_card(ctx: commands.context.Context, card: str):
+    card = card_index.resolve_id(card) or card
+
     if card not in CARD_LIST:
-        await ctx.send(f'{ctx.message.author.mention} Unknown card {card}')
+        await ctx.send(f'{ctx.message.author.mention} Unknown card {card}{card_index.did_you_mean(card)}')
         return False
     else:
         card_name = CARD_LIST[card]
-        file = discord.File(f'card-images/{card}.png', filename=f'{card_name}.png')
-        await ctx.send(f'{ctx.message.author.nick or ctx.message.author.name} plays {card_name}', file=file)
+        content = f'{ctx.message.author.nick or ctx.message.author.name} plays {card_name}'
+        filename = card_images.filename(card, card_name)
+        url = await card_attachments.url_for(card) or await card_attachments.upload(card, filename)
+
+        if url:
+            await ctx.send(content, embed=discord.Embed().set_image(url=url))
+        else:
+            file = await card_images.file(card, filename=filename)
+            message = await ctx.send(content, file=file)
+            card_attachments.record(card, message)
+
         return True
 
 
+@bot.command(name='card', help='Finds cards by ID or name')
+async def find_card(ctx: commands.context.Context, *, query: str):
+    matches = card_index.search(query)
+
+    if not matches:
+        await ctx.send(f'{ctx.message.author.mention} No cards found matching `{query}`')
+        return
+
+    await ctx.send('\n'.join([f'`{card_id}` {CARD_LIST[card_id]}' for card_id in matches]))
+
+
+@bot.command(name='reload-cards', help='Reloads cards.json and the card images without restarting the bot')
+@commands.has_role(control_role_name)
+async def reload_cards_command(ctx: commands.context.Context):
+    try:
+        changed, missing = await reload_cards()
+    except (OSError, ValueError) as error:
+        await ctx.reply(f'Couldn\'t read the cards: `{error}`')
+        return
+
+    if missing:
+        await ctx.reply(f'Cards not reloaded, there\'s no image for: {", ".join(missing)}')
+        return
+
+    await ctx.reply(f'Reloaded {len(CARD_LIST)} cards ({len(changed)} changed)')
+
+
+@bot.command(name='card-stats', help='Shows how the card image and upload caches are doing')
+@commands.has_role(control_role_name)
+async def card_stats(ctx: commands.context.Context):
+    preload = f'{card_images.preload_seconds:.2f}s' if card_images.preload_seconds is not None else 'not finished'
+
+    await ctx.send(
+        f'Card images: {len(card_images.images)} cached, '
+        f'{card_images.size / 1024 / 1024:.1f}MB of {card_images.max_bytes / 1024 / 1024:.1f}MB used\n'
+        f'Hits: {card_images.hits}, misses: {card_images.misses}\n'
+        f'Preload took {preload}\n'
+        f'Uploaded cards: {len(card_attachments.urls)} known, {card_attachments.reuses} reused, '
+        f'{card_attachments.uploads} uploaded, {card_attachments.dead} found dead\n'
+        f'Next card prefetched: {card_prefetcher.hits} times, not prefetched: {card_prefetcher.misses} times'
+    )
+
+
 async def create_category(guild, name, overwrites=None, text_channels=None, voice_channels=None):
     if voice_channels is None:
         voice_channels = {}
@@ -931,6 +3090,7 @@ CORPORATION_ROLE_NAMES = {
 
 @bot.command(name='starting-facilities', help='Builds all the starting facilities')
 @commands.has_role(control_role_name)
+@background_priority
 async def build_starting_facilities(ctx: commands.context.Context):
     starting_facilities = {
         'augmented': [
@@ -1037,7 +3197,7 @@ async def raw_build_facility(ctx: commands.context.Context, short_corp: str, fac
 
     facilities.append([facility_name, facility_type])
 
-    table_string = tabulate.tabulate(facilities, ["Facility name", "Facility Type"], tablefmt="github")
+    table_string = render.github_table(facilities, ["Facility name", "Facility Type"])
     message_contents = f'{corporation_name} facilities:\n```\n{table_string}\n```'
 
     if message_to_edit:
@@ -1089,9 +3249,9 @@ async def build_facility(ctx: commands.context.Context, short_corp: str, facilit
 
 @bot.command(name='destroy-facility', help='Remove a facility')
 @commands.has_role(control_role_name)
+@background_priority
 async def remove_facility(ctx: commands.context.Context, short_corp: str, facility_name: str):
     from discord import TextChannel
-    from tabulate import tabulate
 
     guild: discord.Guild = ctx.guild
 
@@ -1106,7 +3266,7 @@ async def remove_facility(ctx: commands.context.Context, short_corp: str, facili
             facilities = await facility_from_message(message)
             facilities = list(filter(lambda x: x[0] != facility_name, facilities))
 
-            table_string = tabulate(facilities, ["Facility name", "Facility Type"], tablefmt="github")
+            table_string = render.github_table(facilities, ["Facility name", "Facility Type"])
             message_contents = f'{corporation_name} facilities:\n```\n{table_string}\n```'
 
             await channel.send(message_contents)
@@ -1128,24 +3288,38 @@ async def facility_from_message(message):
     return [[y.strip() for y in x.split('|')[1:-1]] for x in message.content.split("\n")[4:-1]]
 
 
-@bot.command(name='roll', help='Rolls dice')
-async def roll_dice(ctx: commands.context.Context, die_string: str):
+@bot.command(name='roll', help='Rolls dice - e.g. `6d8`, or several pools and a bonus like `6d8 4d6 +2`')
+async def roll_dice(ctx: commands.context.Context, *die_strings: str):
     try:
-        (amount, die_type) = die_string.lower().split('d')
-        amount = int(amount)
-        die_type = int(die_type)
-    except ValueError:
-        await ctx.send(f'{ctx.message.author.mention} dice format unknown - use `1d6`, `5d8` etc')
+        pools, modifier = dice.parse_dice(die_strings, dice_max_sides)
+    except ValueError as error:
+        await ctx.send(f'{ctx.message.author.mention} {error.args[0]} - use `1d6`, `5d8` etc')
         return
 
-    values = [random.randint(1, die_type) for _ in range(amount)]
-    values.sort(reverse=True)
-    values = [f"**{x}**" if x >= 5 else str(x) for x in values]
-    success = list(filter(lambda x: x[0] == '*', values))
+    total_dice = sum(pool.amount for pool in pools)
+
+    if total_dice > dice_max:
+        await ctx.send(f'{ctx.message.author.mention} too many dice - you can roll at most {dice_max} at once')
+        return
 
-    result = f'{len(success)} successes\nRolls: {", ".join(values)}'
+    if total_dice > dice_detail_limit:
+        # Big rolls happen off the event loop, so they can't hold up everyone else's commands
+        rolls = await asyncio.get_event_loop().run_in_executor(
+            None, dice.roll_pools, pools, dice_success_threshold
+        )
+    else:
+        rolls = dice.roll_pools(pools, dice_success_threshold)
+
+    # The dice typed are echoed back, cut short so that a long list of them can't crowd out the result
+    typed = ' '.join(die_strings)
+    typed = typed if len(typed) <= dice_echo_limit else typed[:dice_echo_limit] + ' …'
+    reply = f'{ctx.message.author.mention} rolls `{typed}`: '
+    result = dice.format_rolls(
+        rolls, modifier, dice_success_threshold, dice_detail_limit, status_message_limit - len(reply)
+    )
 
-    await ctx.send(f'{ctx.message.author.mention} rolls `{die_string}`: {result}')
+    await ctx.send(reply + result)
 
 
-bot.run(TOKEN)
+if __name__ == '__main__':
+    bot.run(TOKEN)
@@ -0,0 +1,254 @@
+# simulate.py
+"""
+Monte Carlo simulation of facility runs, using the bot's own rules for alerts, bonus dice and boost costs.
+
+Each simulated run goes like this:
+
+- A group of runners starts the run, triggering alerts as start-run does
+- At each protection card the runners roll their attack dice, and the card rolls its own dice plus bonus dice for the
+  alerts, its boost and its depth, as calculate-strength works them out
+- If the runners get more successes they move on to the next card. Otherwise the difference (at least 1) is added to
+  the alerts and they try the card again, until they've failed max_failures times and the run ends
+- Security spreads the boost budget across the cards as evenly as the boost cost allows
+
+Uses numpy when it's installed, and can split the trials across several processes either way.
+
+Run `python simulate.py --help` for the options.
+"""
+import argparse
+import concurrent.futures
+import random
+import time
+
+import rules
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SimulationSettings:
+
+    def __init__(self, runners: int, cards: int, attack_dice: int = 6, card_dice: int = 3, boost_budget: int = 0,
+                 max_failures: int = 1, sides: int = 8, threshold: int = 5):
+        self.runners = runners
+        self.cards = cards
+        self.attack_dice = attack_dice
+        self.card_dice = card_dice
+        self.boost_budget = boost_budget
+        self.max_failures = max_failures
+        self.sides = sides
+        self.threshold = threshold
+
+    @property
+    def success_chance(self):
+        return min(max(self.sides - self.threshold + 1, 0), self.sides) / self.sides
+
+    def boosts(self):
+        return spread_boost(self.boost_budget, self.cards)
+
+
+class SimulationResult:
+
+    def __init__(self, settings: SimulationSettings, trials: int, depths: dict, alerts: dict, seconds: float):
+        self.settings = settings
+        self.trials = trials
+        self.depths = depths
+        self.alerts = alerts
+        self.seconds = seconds
+
+    def alerts_percentile(self, percentile):
+        seen = 0
+
+        for alerts in sorted(self.alerts):
+            seen += self.alerts[alerts]
+
+            if seen >= self.trials * percentile / 100:
+                return alerts
+
+        return 0
+
+    def summary(self):
+        depths = ', '.join([
+            f'{depth}{" (all)" if depth == self.settings.cards else ""}: '
+            f'{self.depths.get(depth, 0) / self.trials * 100:.1f}%'
+            for depth in range(self.settings.cards + 1)
+        ])
+        average_alerts = sum(alerts * count for (alerts, count) in self.alerts.items()) / self.trials
+
+        return (
+            f'{self.trials} runs in {self.seconds:.2f}s\n'
+            f'Cards beaten: {depths}\n'
+            f'Alerts at the end: average {average_alerts:.1f}, median {self.alerts_percentile(50)}, '
+            f'90th percentile {self.alerts_percentile(90)}'
+        )
+
+
+def spread_boost(budget: int, cards: int):
+    """Spends the budget a point at a time on whichever card has the least boost, while there's enough left"""
+    boosts = [0] * cards
+
+    while cards:
+        card = boosts.index(min(boosts))
+        cost = rules.boost_cost(boosts[card], boosts[card] + 1)
+
+        if cost > budget:
+            break
+
+        budget -= cost
+        boosts[card] += 1
+
+    return boosts
+
+
+def bonus_from_alerts(alerts):
+    """rules.bonus_from_alerts for an array of alerts at once"""
+    return numpy.floor(-0.5 + numpy.sqrt(0.25 + 2 * alerts)).astype(numpy.int64)
+
+
+def simulate_chunk_numpy(settings: SimulationSettings, trials: int, seed):
+    rng = numpy.random.default_rng(seed)
+    p = settings.success_chance
+    boosts = settings.boosts()
+
+    alerts = numpy.full(trials, int(rules.alerts_for_runners(settings.runners)), dtype=numpy.int64)
+    failures = numpy.zeros(trials, dtype=numpy.int64)
+    depths = numpy.zeros(trials, dtype=numpy.int64)
+    running = numpy.ones(trials, dtype=bool)
+
+    for depth in range(settings.cards):
+        at_card = running.copy()
+
+        while at_card.any():
+            runs = numpy.flatnonzero(at_card)
+
+            card_dice = (
+                settings.card_dice + bonus_from_alerts(alerts[runs]) + boosts[depth] + rules.bonus_from_depth(depth)
+            )
+
+            attack = rng.binomial(settings.attack_dice, p, runs.size)
+            defence = rng.binomial(card_dice, p)
+            beaten = attack > defence
+
+            depths[runs[beaten]] += 1
+            at_card[runs[beaten]] = False
+
+            lost = runs[~beaten]
+            alerts[lost] += numpy.maximum(defence[~beaten] - attack[~beaten], 1)
+            failures[lost] += 1
+
+            out = lost[failures[lost] >= settings.max_failures]
+            running[out] = False
+            at_card[out] = False
+
+    depth_values, depth_counts = numpy.unique(depths, return_counts=True)
+    alert_values, alert_counts = numpy.unique(alerts, return_counts=True)
+
+    return (
+        dict(zip(depth_values.tolist(), depth_counts.tolist())),
+        dict(zip(alert_values.tolist(), alert_counts.tolist()))
+    )
+
+
+def simulate_chunk_python(settings: SimulationSettings, trials: int, seed):
+    rng = random.Random(seed)
+    p = settings.success_chance
+    boosts = settings.boosts()
+
+    def successes(amount):
+        return sum(1 for _ in range(amount) if rng.random() < p)
+
+    depths = {}
+    alerts_seen = {}
+
+    for _ in range(trials):
+        alerts = int(rules.alerts_for_runners(settings.runners))
+        failures = 0
+        depth = 0
+
+        while depth < settings.cards and failures < settings.max_failures:
+            card_dice = (
+                settings.card_dice + rules.bonus_from_alerts(alerts) + boosts[depth] + rules.bonus_from_depth(depth)
+            )
+            attack = successes(settings.attack_dice)
+            defence = successes(card_dice)
+
+            if attack > defence:
+                depth += 1
+            else:
+                alerts += max(defence - attack, 1)
+                failures += 1
+
+        depths[depth] = depths.get(depth, 0) + 1
+        alerts_seen[alerts] = alerts_seen.get(alerts, 0) + 1
+
+    return depths, alerts_seen
+
+
+def simulate_chunk(settings: SimulationSettings, trials: int, seed):
+    if numpy is not None:
+        return simulate_chunk_numpy(settings, trials, seed)
+
+    return simulate_chunk_python(settings, trials, seed)
+
+
+def simulate(settings: SimulationSettings, trials: int, workers: int = 1, seed=None) -> SimulationResult:
+    if trials < 1:
+        raise ValueError('Simulate at least one run')
+
+    if settings.runners < 0 or settings.cards < 0 or settings.attack_dice < 0 or settings.card_dice < 0:
+        raise ValueError('Runners, cards and dice can\'t be negative')
+
+    start = time.perf_counter()
+    seeds = random.Random(seed).sample(range(2 ** 32), max(workers, 1))
+    chunks = [trials // len(seeds) + (1 if i < trials % len(seeds) else 0) for i in range(len(seeds))]
+
+    if len(seeds) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(seeds)) as executor:
+            results = list(executor.map(simulate_chunk, [settings] * len(seeds), chunks, seeds))
+    else:
+        results = [simulate_chunk(settings, trials, seeds[0])]
+
+    depths = {}
+    alerts = {}
+
+    for chunk_depths, chunk_alerts in results:
+        for depth, count in chunk_depths.items():
+            depths[depth] = depths.get(depth, 0) + count
+
+        for alert, count in chunk_alerts.items():
+            alerts[alert] = alerts.get(alert, 0) + count
+
+    return SimulationResult(settings, trials, depths, alerts, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulates lots of facility runs')
+    parser.add_argument('--runners', type=int, default=4, help='Runners in the group')
+    parser.add_argument('--cards', type=int, default=8, help='Protection cards in the facility')
+    parser.add_argument('--attack-dice', type=int, default=6, help='Dice the runners roll against each card')
+    parser.add_argument('--card-dice', type=int, default=3, help='Dice each card rolls before any bonus')
+    parser.add_argument('--boost-budget', type=int, default=0, help='What security can spend on boosting')
+    parser.add_argument('--max-failures', type=int, default=1, help='Failed cards before the runners give up')
+    parser.add_argument('--sides', type=int, default=8, help='Sides on each die')
+    parser.add_argument('--threshold', type=int, default=5, help='Lowest roll that counts as a success')
+    parser.add_argument('--trials', type=int, default=1000000, help='Runs to simulate')
+    parser.add_argument('--workers', type=int, default=1, help='Processes to split the runs across')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable results')
+    args = parser.parse_args()
+
+    if args.trials < 1 or min(args.runners, args.cards, args.attack_dice, args.card_dice) < 0:
+        parser.error('simulate at least one run, with no negative runners, cards or dice')
+
+    result = simulate(
+        SimulationSettings(
+            args.runners, args.cards, args.attack_dice, args.card_dice, args.boost_budget, args.max_failures,
+            args.sides, args.threshold
+        ),
+        args.trials,
+        args.workers,
+        args.seed
+    )
+
+    print(result.summary())